@@ -55,6 +55,7 @@ setup(
         'bin/syntool-add-data',
         'bin/syntool-histogram',
         'bin/syntool-extract',
+        'bin/syntool-rebuild',
     ],
     license='AGPLv3',
     description='Handle metadata retrieval and update in Syntool.',
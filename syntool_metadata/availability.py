@@ -0,0 +1,187 @@
+# -*- encoding: utf-8 -*-
+
+"""
+@author: <sylvain.herledan@oceandatalab.com>
+"""
+
+"""
+Copyright (C) 2014-2018 OceanDataLab
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import datetime
+import numpy
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def to_days(dates):
+    """Convert a sequence of dates (or datetimes) to numbers of days since
+    1970-01-01."""
+    days = numpy.fromiter((d.toordinal() for d in dates), dtype=numpy.int64,
+                          count=len(dates))
+    return days - EPOCH_ORDINAL
+
+
+def rollup(keys, values):
+    """Sum the columns of values over runs of identical keys.
+
+    keys must be sorted, which is the case for the year, month or day of
+    consecutive days."""
+    boundaries = numpy.flatnonzero(numpy.diff(keys)) + 1
+    starts = numpy.concatenate(([0], boundaries))
+    return keys[starts], numpy.add.reduceat(values, starts, axis=-1)
+
+
+class DayAvailability(object):
+    """Day-indexed availability of a list of products.
+
+    Each product contributes either time ranges, as returned by
+    Storage.get_product_availability, or individual days, as sent by the
+    client. Counts are stored in arrays with one column per day so that
+    rollups and colocation are computed with array reductions."""
+
+    def __init__(self, products_count):
+        """ """
+        self.products_count = products_count
+        self.__ranges = [[] for _ in xrange(products_count)]
+        self.__days = [[] for _ in xrange(products_count)]
+
+    def add_ranges(self, product_index, arities, starts, stops):
+        """Register arities[i] datasets for each day between starts[i] and
+        stops[i] (inclusive, expressed in days since 1970-01-01)."""
+        arities = numpy.asarray(arities, dtype=numpy.int64)
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        stops = numpy.asarray(stops, dtype=numpy.int64)
+        valid = starts <= stops
+        if not numpy.any(valid):
+            return
+        self.__ranges[product_index].append((arities[valid], starts[valid],
+                                             stops[valid]))
+
+    def add_days(self, product_index, arities, days):
+        """Register arities[i] datasets for days[i] (expressed in days since
+        1970-01-01)."""
+        arities = numpy.asarray(arities, dtype=numpy.int64)
+        days = numpy.asarray(days, dtype=numpy.int64)
+        if 0 >= days.size:
+            return
+        self.__days[product_index].append((arities, days))
+
+    def get_bounds(self):
+        """ """
+        lower = []
+        upper = []
+        for product_ranges in self.__ranges:
+            for _, starts, stops in product_ranges:
+                lower.append(starts.min())
+                upper.append(stops.max())
+        for product_days in self.__days:
+            for _, days in product_days:
+                lower.append(days.min())
+                upper.append(days.max())
+        if 0 >= len(lower):
+            return None, None
+        return min(lower), max(upper)
+
+    def get_counts(self):
+        """Return the first day and two (products, days) arrays: the number
+        of datasets and the number of availability entries for each day."""
+        first_day, last_day = self.get_bounds()
+        if first_day is None:
+            empty = numpy.zeros((self.products_count, 0), dtype=numpy.int64)
+            return 0, empty, empty
+
+        width = last_day - first_day + 1
+        # Ranges are expanded with a cumulative sum over +arity at their
+        # start and -arity after their stop.
+        counts = numpy.zeros((self.products_count, width + 1),
+                             dtype=numpy.int64)
+        hits = numpy.zeros((self.products_count, width + 1),
+                           dtype=numpy.int64)
+        for product_index, product_ranges in enumerate(self.__ranges):
+            for arities, starts, stops in product_ranges:
+                numpy.add.at(counts[product_index], starts - first_day,
+                             arities)
+                numpy.add.at(counts[product_index], stops - first_day + 1,
+                             -arities)
+                numpy.add.at(hits[product_index], starts - first_day, 1)
+                numpy.add.at(hits[product_index], stops - first_day + 1, -1)
+        counts = numpy.cumsum(counts, axis=1)[:, :width]
+        hits = numpy.cumsum(hits, axis=1)[:, :width]
+
+        for product_index, product_days in enumerate(self.__days):
+            for arities, days in product_days:
+                numpy.add.at(counts[product_index], days - first_day, arities)
+                numpy.add.at(hits[product_index], days - first_day, 1)
+
+        return first_day, counts, hits
+
+    def summarize(self, year, month, products):
+        """Build the availability.service.php result: per-year statistics,
+        per-month statistics for the requested year and per-day statistics
+        for the requested month."""
+        result = { 'years': {}
+                 , 'months': {}
+                 , 'days': {}
+                 }
+
+        first_day, counts, hits = self.get_counts()
+        if 0 >= counts.shape[1]:
+            return result
+
+        days = numpy.arange(first_day, first_day + counts.shape[1])
+        days = days.astype('datetime64[D]')
+        first_of_month = days.astype('datetime64[M]')
+        years = days.astype('datetime64[Y]').astype(numpy.int64) + 1970
+        months = first_of_month.astype(numpy.int64) % 12 + 1
+        mdays = (days - first_of_month.astype('datetime64[D]'))
+        mdays = mdays.astype(numpy.int64) + 1
+
+        present = 0 < hits
+        coloc = numpy.all(present, axis=0).astype(numpy.int64)
+
+        def period_stats(keys, mask, with_coloc):
+            """ """
+            period = {}
+            if not numpy.any(mask):
+                return period
+            period_keys, period_counts = rollup(keys[mask], counts[:, mask])
+            _, period_hits = rollup(keys[mask], hits[:, mask])
+            _, period_coloc = rollup(keys[mask], coloc[mask])
+            datasets = period_counts.sum(axis=0)
+            period_present = 0 < period_hits
+            for i, key in enumerate(period_keys):
+                products_indices = numpy.flatnonzero(period_present[:, i])
+                if 0 >= products_indices.size:
+                    continue
+                stats = { 'datasets': int(datasets[i])
+                        , 'products': [int(x) + 1 for x in products_indices]
+                        }
+                if with_coloc:
+                    if 0 < period_coloc[i]:
+                        stats['coloc'] = products
+                    else:
+                        stats['coloc'] = []
+                period[int(key)] = stats
+            return period
+
+        all_days = numpy.ones(days.shape, dtype=numpy.bool_)
+        result['years'] = period_stats(years, all_days, True)
+        in_year = (years == year)
+        result['months'] = period_stats(months, in_year, True)
+        in_month = in_year & (months == month)
+        result['days'] = period_stats(mdays, in_month, False)
+        return result
@@ -0,0 +1,104 @@
+# -*- encoding: utf-8 -*-
+
+"""
+@author: <sylvain.herledan@oceandatalab.com>
+"""
+
+"""
+Copyright (C) 2014-2018 OceanDataLab
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import collections
+import threading
+
+
+class LRUCache(object):
+    """Thread-safe mapping which only keeps the most recently used items.
+
+    Items are evicted when there are more than max_entries of them or when
+    their total size, as computed by sizeof, exceeds max_bytes. Either limit
+    can be disabled by setting it to None."""
+
+    def __init__(self, max_entries, max_bytes=None, sizeof=None):
+        """ """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self.__items = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        """ """
+        return len(self.__items)
+
+    def get(self, key, default=None):
+        """ """
+        with self.__lock:
+            try:
+                value, value_size = self.__items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.__items[key] = (value, value_size)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """ """
+        value_size = 0
+        if self.sizeof is not None:
+            value_size = self.sizeof(value)
+        with self.__lock:
+            self.__pop(key)
+            if self.max_bytes is not None and self.max_bytes < value_size:
+                # Would evict everything else
+                return
+            self.__items[key] = (value, value_size)
+            self.size += value_size
+            while (self.max_entries is not None \
+                   and self.max_entries < len(self.__items)) \
+            or (self.max_bytes is not None and self.max_bytes < self.size):
+                _, (_, evicted_size) = self.__items.popitem(last=False)
+                self.size -= evicted_size
+
+    def __pop(self, key):
+        """ """
+        item = self.__items.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
+
+    def invalidate(self, key):
+        """ """
+        with self.__lock:
+            self.__pop(key)
+
+    def clear(self):
+        """ """
+        with self.__lock:
+            self.__items.clear()
+            self.size = 0
+
+    def get_stats(self):
+        """ """
+        with self.__lock:
+            return { 'entries': len(self.__items)
+                   , 'size': self.size
+                   , 'hits': self.hits
+                   , 'misses': self.misses
+                   }
@@ -25,11 +25,17 @@ import sqlalchemy.ext.declarative
 from sqlalchemy import func,cast,desc
 from sqlalchemy.types import UserDefinedType
 from sqlalchemy.engine import Engine,reflection
-import ConfigParser
+import syntool_metadata.availability
+import syntool_metadata.features
 import contextlib
+import hashlib
+import multiprocessing.pool
+import numpy
+import threading
 import datetime
 import calendar
 import logging
+import time
 import os
 
 logger = logging.getLogger(__name__)
@@ -61,6 +67,13 @@ class Product(Base):
         """ """
         self.type = 'ZXY'
 
+class Generation(Base):
+    """Counter incremented each time a dataset is added to a product, used
+    to invalidate cached responses."""
+    __tablename__ = 'generations'
+    product_id = sqlalchemy.Column(sqlalchemy.types.VARCHAR(255), primary_key=True)
+    generation = sqlalchemy.Column(sqlalchemy.types.BIGINT, nullable=False)
+
 class Dataset():
     """ """
     dataset_name = sqlalchemy.Column(sqlalchemy.types.VARCHAR(255), nullable=False, primary_key=True)
@@ -71,9 +84,132 @@ class Dataset():
     max_zoom_level = sqlalchemy.Column(sqlalchemy.types.INTEGER, nullable=False)
     resolutions = sqlalchemy.Column(sqlalchemy.types.TEXT, nullable=False)
     bbox_text = sqlalchemy.Column(sqlalchemy.types.TEXT, nullable=False)
-    bbox_geometry = sqlalchemy.Column(Geometry, nullable=True)
+    bbox_geometry = sqlalchemy.Column(Geometry, nullable=False)
     shape_text = sqlalchemy.Column(sqlalchemy.types.TEXT, nullable=False)
     shape_geometry = sqlalchemy.Column(Geometry, nullable=False)
+    mid_timestamp = sqlalchemy.Column(sqlalchemy.types.Numeric(precision=12, scale=1, asdecimal=False), nullable=True, index=True)
+    is_global = sqlalchemy.Column(sqlalchemy.types.BOOLEAN, nullable=False, default=False, server_default='0')
+    # bbox_geometry holds the envelope of the shape and has a spatial index
+    bbox_index = True
+
+    @sqlalchemy.ext.declarative.declared_attr
+    def __table_args__(cls):
+        """ """
+        return ( sqlalchemy.Index( 'sx_{}_bbox_geometry'.format(cls.__tablename__)
+                                 , 'bbox_geometry', mysql_prefix='SPATIAL')
+               , sqlalchemy.Index( 'sx_{}_shape_geometry'.format(cls.__tablename__)
+                                 , 'shape_geometry', mysql_prefix='SPATIAL')
+               )
+
+# Columns added to the product tables after their creation, they are only
+# mapped once a table has been migrated with syntool-rebuild
+MIGRATED_COLUMNS = ['mid_timestamp', 'is_global']
+
+# Bounding box stored for datasets with a global coverage (shape_text is
+# "POINT(0 0)"), large enough to intersect any extent in any projection.
+GLOBAL_BBOX_POLYGON = 'POLYGON((-1000000000 1000000000, 1000000000 1000000000, 1000000000 -1000000000, -1000000000 -1000000000, -1000000000 1000000000))'
+
+class DailyAvailability():
+    """Number of datasets of a product covering each day."""
+    day = sqlalchemy.Column(sqlalchemy.types.DATE, nullable=False, primary_key=True)
+    datasets = sqlalchemy.Column(sqlalchemy.types.INTEGER, nullable=False)
+
+class NameTrigram():
+    """Trigrams contained in the names of the datasets of a product, used
+    to resolve name patterns without a full table scan."""
+    trigram = sqlalchemy.Column(sqlalchemy.types.VARCHAR(3), nullable=False, primary_key=True)
+    dataset_name = sqlalchemy.Column(sqlalchemy.types.VARCHAR(255), nullable=False, primary_key=True, index=True)
+
+def get_name_trigrams(name):
+    """ """
+    name = name.lower()
+    return set([name[i:i + 3] for i in xrange(len(name) - 2)])
+
+def get_pattern_trigrams(pattern):
+    """Return the trigrams that a name must contain to match the LIKE
+    expression %pattern%."""
+    trigrams = set()
+    # "%" and "_" are wildcards for LIKE
+    for chunk in pattern.replace('%', '_').split('_'):
+        trigrams.update(get_name_trigrams(chunk))
+    return trigrams
+
+DATETIME_FORMATS = [ '%Y-%m-%dT%H:%M:%S'
+                   , '%Y-%m-%d %H:%M:%S'
+                   , '%Y-%m-%dT%H:%M:%S.%f'
+                   , '%Y-%m-%d %H:%M:%S.%f'
+                   , '%Y-%m-%d'
+                   ]
+
+def parse_datetime(value):
+    """ """
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime.combine(value, datetime.time())
+    value = value.strip().rstrip('Z')
+    for datetime_format in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, datetime_format)
+        except ValueError:
+            pass
+    raise ValueError('Unsupported datetime format: {}'.format(value))
+
+
+# Catalog cache
+# ----------------------------------------------------------------------------
+DEFAULT_CATALOG_TTL = 60
+
+
+class CatalogCache(object):
+    """In-process copy of the database catalog: names of the existing tables
+    and type/shortname of the registered products.
+
+    Read-only requests use this cache instead of querying the information
+    schema every time. Entries expire after ttl seconds and the cache must be
+    invalidated when tables or products are created."""
+
+    def __init__(self, ttl=DEFAULT_CATALOG_TTL):
+        """ """
+        self.ttl = ttl
+        self.tables = frozenset()
+        self.product_types = {}
+        self.shortnames = {}
+        self.__refreshed_at = None
+        self.__lock = threading.Lock()
+
+    def is_stale(self):
+        """ """
+        refreshed_at = self.__refreshed_at
+        if refreshed_at is None:
+            return True
+        return self.ttl < time.time() - refreshed_at
+
+    def invalidate(self):
+        """ """
+        with self.__lock:
+            self.__refreshed_at = None
+
+    def refresh(self, engine):
+        """ """
+        insp = reflection.Inspector.from_engine(engine)
+        tables = frozenset(insp.get_table_names())
+        product_types = {}
+        shortnames = {}
+        if 'products' in tables:
+            q = sqlalchemy.select([ Product.product_id
+                                  , Product.shortname
+                                  , Product.type])
+            for product_id, shortname, product_type in engine.execute(q):
+                product_types[product_id] = product_type
+                shortnames[product_id] = shortname
+
+        with self.__lock:
+            self.tables = tables
+            self.product_types = product_types
+            self.shortnames = shortnames
+            self.__refreshed_at = time.time()
+        logger.debug('Catalog refreshed: {} tables'.format(len(tables)))
 
 
 # Storage implementation
@@ -84,35 +220,298 @@ def set_mysql_time_zone(dbapi_connection, connection_record):
     cursor.execute("SET time_zone = '+0:0'")
     cursor.close()
 
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_RECYCLE = 3600
+DEFAULT_POOL_TIMEOUT = 30
+DEFAULT_QUERY_WORKERS = 1
+# Seconds during which the generation counters are not read again, i.e.
+# delay before cached responses show new datasets
+DEFAULT_GENERATION_TTL = 1
+# Number of rows fetched at once from server-side cursors
+STREAM_BATCH_SIZE = 500
+# Maximum number of names found in the name index for a pattern, above
+# which the product table is scanned instead
+MAX_PATTERN_CANDIDATES = 5000
+# Seconds waited for the lock of a product, see Storage.lock_product
+DEFAULT_LOCK_TIMEOUT = 3600
+
+
 class Storage(object):
     """ """
 
-    def __init__(self, db_url, *args, **kwargs):
+    def __init__( self, db_url, catalog_ttl=DEFAULT_CATALOG_TTL
+                , pool_size=DEFAULT_POOL_SIZE
+                , max_overflow=DEFAULT_MAX_OVERFLOW
+                , pool_recycle=DEFAULT_POOL_RECYCLE
+                , pool_pre_ping=True
+                , pool_timeout=DEFAULT_POOL_TIMEOUT
+                , connect_timeout=None
+                , generation_ttl=DEFAULT_GENERATION_TTL
+                , query_workers=DEFAULT_QUERY_WORKERS
+                , *args, **kwargs):
         """ """
         super(Storage, self).__init__(*args, **kwargs)
         self.product_tables = {}
+        self.availability_tables = {}
+        self.name_index_tables = {}
+        connect_args = {}
+        if connect_timeout is not None:
+            connect_args['connect_timeout'] = connect_timeout
         self.__engine = sqlalchemy.create_engine( db_url, echo=False
-                                                , pool_recycle=10)
+                                                , pool_size=pool_size
+                                                , max_overflow=max_overflow
+                                                , pool_recycle=pool_recycle
+                                                , pool_pre_ping=pool_pre_ping
+                                                , pool_timeout=pool_timeout
+                                                , connect_args=connect_args)
+        self.__connections_created = 0
+        sqlalchemy.event.listen(self.__engine, 'connect', self.__on_connect)
+
+        # Sessions are bound to the calling thread so that a Storage instance
+        # can be shared by the threads of the WSGI server.
+        session_factory = sqlalchemy.orm.sessionmaker(bind=self.__engine)
+        self.__session = sqlalchemy.orm.scoped_session(session_factory)
+
         self.Base = sqlalchemy.ext.declarative.declarative_base()
+        self.catalog = CatalogCache(catalog_ttl)
+        self.generation_ttl = generation_ttl
+        self.__generations = (None, {})
+
+        # Per-product availability queries run concurrently when
+        # query_workers > 1, each worker thread gets its own session (and
+        # pooled connection) from the scoped session.
+        self.query_workers = query_workers
+        self.__query_pool = None
+        self.__query_pool_lock = threading.Lock()
+
+    def __on_connect(self, dbapi_connection, connection_record):
+        """ """
+        self.__connections_created += 1
+
+    def get_pool_status(self):
+        """Return statistics about the connection pool."""
+        pool = self.__engine.pool
+        status = { 'status': pool.status()
+                 , 'connections_created': self.__connections_created
+                 }
+        for name in ['size', 'checkedin', 'checkedout', 'overflow']:
+            method = getattr(pool, name, None)
+            if method is not None:
+                status[name] = method()
+        return status
+
+    def map_products(self, function, products):
+        """Return [function(product_id) for product_id in products].
+
+        When query_workers is greater than 1 the calls are distributed over
+        a pool of query_workers threads, results keep the order of
+        products."""
+        if 1 >= self.query_workers or 1 >= len(products):
+            return [function(product_id) for product_id in products]
+
+        # Declaring the table classes is not thread-safe
+        for product_id in products:
+            self.get_product_table(product_id)
+            self.get_availability_table(product_id)
+            self.get_name_index_table(product_id)
+
+        def run(product_id):
+            try:
+                return function(product_id)
+            finally:
+                self.__session.remove()
+
+        with self.__query_pool_lock:
+            if self.__query_pool is None:
+                self.__query_pool = multiprocessing.pool.ThreadPool(self.query_workers)
+        return self.__query_pool.map(run, products)
+
+    def get_catalog(self):
+        """Return the catalog cache, refreshed if it has expired."""
+        if self.catalog.is_stale():
+            self.catalog.refresh(self.__engine)
+        return self.catalog
+
+    def refresh_catalog(self):
+        """Reload the catalog cache immediately, for example after products
+        have been added to the database by another process."""
+        self.catalog.refresh(self.__engine)
+
+    def get_existing_tables(self):
+        """ """
+        return self.get_catalog().tables
+
+    def get_product_type(self, product_id):
+        """ """
+        product_type = self.get_catalog().product_types.get(product_id, None)
+        if product_type is None:
+            # Product registered after the last refresh
+            q = self.__session.query(Product.type)
+            q = q.filter(Product.product_id==product_id)
+            product_type = q.first()[0]
+        return product_type
+
+    def get_generations(self):
+        """Return the generation counter of each product.
+
+        Counters are read from the database at most once every
+        generation_ttl seconds."""
+        read_at, generations = self.__generations
+        if read_at is not None and time.time() - read_at < self.generation_ttl:
+            return generations
+        if 'generations' not in self.get_existing_tables():
+            return {}
+        q = sqlalchemy.select([Generation.product_id, Generation.generation])
+        with self.__engine.connect() as connection:
+            generations = dict(connection.execute(q).fetchall())
+        self.__generations = (time.time(), generations)
+        return generations
+
+    def increment_generation(self, product_id):
+        """ """
+        stmt = sqlalchemy.text( 'INSERT INTO generations (product_id, generation) VALUES (:product_id, 1) '
+                                'ON DUPLICATE KEY UPDATE generation = generation + 1')
+        self.__session.execute(stmt, {'product_id': product_id})
 
     def get_product_table(self, product_id):
         fixed_product_id = product_id.replace(' ', '_')
         if fixed_product_id not in self.product_tables:
+            table_name = 'product_{}'.format(fixed_product_id)
+            attributes = {'__tablename__': table_name}
+            if table_name in self.get_existing_tables():
+                # Leave out the columns that a table created by a previous
+                # version does not have yet (the mapping is kept until the
+                # process restarts)
+                columns = self.get_table_columns(table_name)
+                for column_name in MIGRATED_COLUMNS:
+                    if column_name not in columns:
+                        attributes[column_name] = None
+                # The spatial index is added once bbox_geometry is filled
+                bbox_index = 'sx_{}_bbox_geometry'.format(table_name)
+                attributes['bbox_index'] = bbox_index in self.get_table_indexes(table_name)
             self.product_tables[fixed_product_id] = type( 'Dataset_{}'.format(fixed_product_id)
                                                         , (self.Base, Dataset)
-                                                        , {'__tablename__': 'product_{}'.format(fixed_product_id)}
+                                                        , attributes
                                                         )
         return self.product_tables[fixed_product_id]
 
+    @staticmethod
+    def get_mid_timestamp(dataset_cls):
+        """Return the expression of the middle of the time coverage of the
+        datasets, read from the indexed mid_timestamp column when the table
+        has it."""
+        if dataset_cls.mid_timestamp is not None:
+            return dataset_cls.mid_timestamp
+        return (func.unix_timestamp(dataset_cls.begin_datetime) + func.unix_timestamp(dataset_cls.end_datetime)) / 2
+
     @staticmethod
     def get_product_table_name(product_id):
         return 'product_{}'.format(product_id.replace(' ', '_'))
 
+    def get_availability_table(self, product_id):
+        fixed_product_id = product_id.replace(' ', '_')
+        if fixed_product_id not in self.availability_tables:
+            self.availability_tables[fixed_product_id] = type( 'DailyAvailability_{}'.format(fixed_product_id)
+                                                             , (self.Base, DailyAvailability)
+                                                             , {'__tablename__': 'availability_{}'.format(fixed_product_id)}
+                                                             )
+        return self.availability_tables[fixed_product_id]
+
+    @staticmethod
+    def get_availability_table_name(product_id):
+        return 'availability_{}'.format(product_id.replace(' ', '_'))
+
+    def get_name_index_table(self, product_id):
+        fixed_product_id = product_id.replace(' ', '_')
+        if fixed_product_id not in self.name_index_tables:
+            self.name_index_tables[fixed_product_id] = type( 'NameTrigram_{}'.format(fixed_product_id)
+                                                           , (self.Base, NameTrigram)
+                                                           , {'__tablename__': 'names_{}'.format(fixed_product_id)}
+                                                           )
+        return self.name_index_tables[fixed_product_id]
+
+    @staticmethod
+    def get_name_index_table_name(product_id):
+        return 'names_{}'.format(product_id.replace(' ', '_'))
+
+    @staticmethod
+    def get_bbox_polygon(bbox_text):
+        """Convert a "west,south,east,north" extent to a WKT polygon."""
+        if bbox_text is None:
+            return None
+        west, south, east, north = bbox_text.split(',')
+        bbox_polygon = 'POLYGON(({} {}, {} {}, {} {}, {} {}, {} {}))'
+        return bbox_polygon.format(west, north, east, north, east, south, west, south, west, north)
+
+    @staticmethod
+    def get_extent_filter(dataset_cls, bbox_polygon):
+        """Filter datasets which intersect bbox_polygon.
+
+        The MBRIntersects test on bbox_geometry is served by a spatial index
+        (the bounding box of global datasets covers the whole world), the
+        exact Intersects test only runs on the rows that pass it. Tables
+        which have not been migrated yet are filtered on the shape only."""
+        bbox_geometry = func.GeomFromText(bbox_polygon)
+        if not dataset_cls.bbox_index or dataset_cls.is_global is None:
+            return sqlalchemy.or_( dataset_cls.shape_text == 'POINT(0 0)'
+                                 , func.Intersects(dataset_cls.shape_geometry, bbox_geometry))
+        return sqlalchemy.and_( func.MBRIntersects(dataset_cls.bbox_geometry, bbox_geometry)
+                              , sqlalchemy.or_( dataset_cls.is_global == True
+                                              , func.Intersects(dataset_cls.shape_geometry, bbox_geometry)))
+
+    def get_pattern_filter(self, product_id, dataset_cls, pattern):
+        """Filter datasets whose name contains pattern.
+
+        When the product has a name index, candidates are first read among
+        the names that contain all the trigrams of the pattern and the
+        datasets are then selected by primary key, the LIKE condition is only
+        a final check. Patterns matched by too many names are resolved with
+        the LIKE condition alone."""
+        like = dataset_cls.dataset_name.like('%{}%'.format(pattern))
+        trigrams = get_pattern_trigrams(pattern)
+        if 0 >= len(trigrams):
+            return like
+        index_table_name = Storage.get_name_index_table_name(product_id)
+        if index_table_name not in self.get_existing_tables():
+            return like
+
+        index_cls = self.get_name_index_table(product_id)
+        q = self.__session.query(index_cls.dataset_name)
+        q = q.filter(index_cls.trigram.in_(trigrams))
+        q = q.group_by(index_cls.dataset_name)
+        q = q.having(func.count(sqlalchemy.distinct(index_cls.trigram)) == len(trigrams))
+        q = q.limit(MAX_PATTERN_CANDIDATES + 1)
+        names = [x[0] for x in q]
+        if MAX_PATTERN_CANDIDATES < len(names):
+            return like
+        if 0 >= len(names):
+            return sqlalchemy.false()
+        return sqlalchemy.and_(dataset_cls.dataset_name.in_(names), like)
+
+    def get_table_columns(self, table_name):
+        """ """
+        insp = reflection.Inspector.from_engine(self.__engine)
+        return [c['name'] for c in insp.get_columns(table_name)]
+
+    def get_table_indexes(self, table_name):
+        """ """
+        insp = reflection.Inspector.from_engine(self.__engine)
+        return [x['name'] for x in insp.get_indexes(table_name)]
+
+    @staticmethod
+    def get_bbox_geometry(shape_wkt):
+        """Return the value of bbox_geometry for a shape: its envelope, or a
+        polygon covering the whole world for global datasets. bbox_text is
+        not used as it does not contain the shapes which cross the
+        antimeridian."""
+        if 'POINT(0 0)' == shape_wkt:
+            return GLOBAL_BBOX_POLYGON
+        return func.Envelope(func.GeomFromText(shape_wkt))
+
     @contextlib.contextmanager
     def get_session(self):
         """ """
-        Session = sqlalchemy.orm.sessionmaker(bind=self.__engine)
-        self.__session = Session()
         try:
             yield self
             self.__session.commit()
@@ -120,20 +519,53 @@ class Storage(object):
             self.__session.rollback()
             raise
         finally:
-            self.__session.close()
+            self.__session.remove()
             logger.info('Session closed')
 
+    @contextlib.contextmanager
+    def lock_product(self, product_id, timeout=DEFAULT_LOCK_TIMEOUT):
+        """Hold the MySQL named lock of a product. Ingestion holds it until
+        the datasets are committed and rebuilds hold it while they read the
+        datasets and replace the tables, so that datasets added during a
+        rebuild are not lost.
+
+        The lock is taken on its own connection, so it may wrap
+        get_session."""
+        name = 'syntool_{}'.format(hashlib.md5(product_id).hexdigest())
+        connection = self.__engine.connect()
+        try:
+            stmt = sqlalchemy.text('SELECT GET_LOCK(:name, :timeout)')
+            locked = connection.execute(stmt, {'name': name, 'timeout': timeout}).scalar()
+            if 1 != locked:
+                raise Exception('Could not lock product {}'.format(product_id))
+            try:
+                yield
+            finally:
+                stmt = sqlalchemy.text('SELECT RELEASE_LOCK(:name)')
+                connection.execute(stmt, {'name': name})
+        finally:
+            connection.close()
+
     def create_product( self, product_id, data_type):
         """ """
-        insp = reflection.Inspector.from_engine(self.__engine)
-        existing_tables = insp.get_table_names()
+        existing_tables = self.get_existing_tables()
         if 'products' not in existing_tables:
             Product.__table__.create(self.__engine, checkfirst=True)
             self.__session.commit()
+        if 'generations' not in existing_tables:
+            Generation.__table__.create(self.__engine, checkfirst=True)
+            self.__session.commit()
         table_name = Storage.get_product_table_name(product_id)
         if table_name not in existing_tables:
             dataset_cls = self.get_product_table(product_id)
             dataset_cls.__table__.create(self.__engine, checkfirst=True)
+            # The daily availability of new products is maintained from the
+            # start, existing products must be processed with
+            # Storage.rebuild_availability
+            availability_cls = self.get_availability_table(product_id)
+            availability_cls.__table__.create(self.__engine, checkfirst=True)
+            index_cls = self.get_name_index_table(product_id)
+            index_cls.__table__.create(self.__engine, checkfirst=True)
             self.__session.commit()
 
         product = self.__session.query(Product).filter_by(product_id=product_id).first()
@@ -147,12 +579,29 @@ class Storage(object):
             product.type = data_type
             self.__session.add(product)
             created = True
+        self.catalog.invalidate()
         return product, created
 
     def create_dataset( self, product_id, name, start, stop, min_zoom, max_zoom
                    , resolutions, bbox_str, shape_str, relative_path=''):
         """ """
+        start = parse_datetime(start)
+        stop = parse_datetime(stop)
         dataset_cls = self.get_product_table(product_id)
+
+        availability_table_name = Storage.get_availability_table_name(product_id)
+        if availability_table_name in self.get_existing_tables():
+            q = self.__session.query(dataset_cls.begin_datetime, dataset_cls.end_datetime)
+            q = q.filter(dataset_cls.dataset_name == name)
+            previous = q.first()
+            if previous is not None:
+                self.update_daily_availability(product_id, previous[0], previous[1], -1)
+            self.update_daily_availability(product_id, start, stop, 1)
+
+        index_table_name = Storage.get_name_index_table_name(product_id)
+        if index_table_name in self.get_existing_tables():
+            self.update_name_index(product_id, name)
+
         dataset = dataset_cls()
         dataset.dataset_name = name
         dataset.relative_path = relative_path
@@ -162,11 +611,197 @@ class Storage(object):
         dataset.max_zoom_level = max_zoom
         dataset.resolutions = ','.join(map(str, resolutions))
         dataset.bbox_text = bbox_str
-        dataset.bbox_geometry = None
+        if dataset_cls.is_global is not None:
+            dataset.is_global = ('POINT(0 0)' == shape_str)
+        dataset.bbox_geometry = Storage.get_bbox_geometry(shape_str)
         dataset.shape_text = shape_str
         dataset.shape_geometry = shape_str
+        if dataset_cls.mid_timestamp is not None:
+            dataset.mid_timestamp = 0.5 * (calendar.timegm(start.timetuple()) +
+                                           calendar.timegm(stop.timetuple()))
         self.__session.merge(dataset)
 
+        if 'generations' in self.get_existing_tables():
+            self.increment_generation(product_id)
+
+    def update_daily_availability(self, product_id, start, stop, delta):
+        """Add delta datasets to the days between start and stop."""
+        table_name = Storage.get_availability_table_name(product_id)
+        first_day = start.date()
+        last_day = stop.date()
+        if last_day < first_day:
+            return
+
+        if 0 > delta:
+            availability_cls = self.get_availability_table(product_id)
+            q = self.__session.query(availability_cls)
+            q = q.filter(availability_cls.day >= first_day)
+            q = q.filter(availability_cls.day <= last_day)
+            q.update({availability_cls.datasets: availability_cls.datasets + delta},
+                     synchronize_session=False)
+            q = self.__session.query(availability_cls)
+            q = q.filter(availability_cls.datasets <= 0)
+            q.delete(synchronize_session=False)
+        else:
+            days_count = (last_day - first_day).days + 1
+            rows = [{'day': first_day + datetime.timedelta(days=i), 'datasets': delta}
+                    for i in xrange(days_count)]
+            stmt = sqlalchemy.text( 'INSERT INTO `{}` (day, datasets) VALUES (:day, :datasets) '
+                                    'ON DUPLICATE KEY UPDATE datasets = datasets + VALUES(datasets)'.format(table_name))
+            self.__session.execute(stmt, rows)
+
+    def migrate_mid_timestamp(self, product_id):
+        """Add the indexed mid_timestamp column to a product table created by
+        a previous version and fill it for the existing datasets.
+
+        Running it again fills the datasets added in the meantime by
+        processes which mapped the table before the column existed."""
+        table_name = Storage.get_product_table_name(product_id)
+        if 'mid_timestamp' not in self.get_table_columns(table_name):
+            stmt = sqlalchemy.text( 'ALTER TABLE `{0}` ADD COLUMN mid_timestamp DECIMAL(12,1) NULL, '
+                                    'ADD INDEX `ix_{0}_mid_timestamp` (mid_timestamp)'.format(table_name))
+            self.__session.execute(stmt)
+
+        # The table may have been mapped before the column existed
+        stmt = sqlalchemy.text( 'UPDATE `{}` SET mid_timestamp = '
+                                '(UNIX_TIMESTAMP(begin_datetime) + UNIX_TIMESTAMP(end_datetime)) / 2 '
+                                'WHERE mid_timestamp IS NULL'.format(table_name))
+        return self.__session.execute(stmt).rowcount
+
+    def update_name_index(self, product_id, name):
+        """ """
+        index_cls = self.get_name_index_table(product_id)
+        q = self.__session.query(index_cls)
+        q = q.filter(index_cls.dataset_name == name)
+        q.delete(synchronize_session=False)
+        rows = [{'trigram': x, 'dataset_name': name} for x in get_name_trigrams(name)]
+        if 0 < len(rows):
+            stmt = index_cls.__table__.insert().prefix_with('IGNORE')
+            self.__session.execute(stmt, rows)
+
+    def rebuild_name_index(self, product_id, batch_size=1000):
+        """(Re)create the name index of a product from the datasets already
+        registered in the database.
+
+        The index is rebuilt under a temporary name, patterns are resolved
+        with the previous index until it is replaced. Call it within
+        lock_product so that no dataset is added in the meantime."""
+        index_cls = self.get_name_index_table(product_id)
+        rebuild_table = self.create_rebuild_table(index_cls.__table__)
+
+        dataset_cls = self.get_product_table(product_id)
+        names = [x[0] for x in self.__session.query(dataset_cls.dataset_name)]
+        stmt = rebuild_table.insert().prefix_with('IGNORE')
+        for i in xrange(0, len(names), batch_size):
+            rows = [{'trigram': trigram, 'dataset_name': name}
+                    for name in names[i:i + batch_size]
+                    for trigram in get_name_trigrams(name)]
+            if 0 < len(rows):
+                self.__session.execute(stmt, rows)
+        self.replace_table(index_cls.__table__, rebuild_table)
+        return len(names)
+
+    def migrate_spatial_index(self, product_id):
+        """Add the is_global column and the spatial indexes to a product
+        table created by a previous version and fill bbox_geometry for the
+        existing datasets."""
+        table_name = Storage.get_product_table_name(product_id)
+        if 'is_global' not in self.get_table_columns(table_name):
+            stmt = sqlalchemy.text( 'ALTER TABLE `{}` ADD COLUMN is_global BOOL NOT NULL DEFAULT 0'.format(table_name))
+            self.__session.execute(stmt)
+
+        # The table may have been mapped before the column existed. All the
+        # rows are updated so that bounding boxes copied from bbox_text by
+        # previous versions are replaced with the envelope of the shape.
+        stmt = sqlalchemy.text( 'UPDATE `{}` SET is_global = (shape_text = :global_shape), '
+                                'bbox_geometry = IF(shape_text = :global_shape, GeomFromText(:global_bbox), '
+                                'Envelope(shape_geometry))'.format(table_name))
+        rows_count = self.__session.execute(stmt, { 'global_shape': 'POINT(0 0)'
+                                                  , 'global_bbox': GLOBAL_BBOX_POLYGON}).rowcount
+
+        # The spatial index requires a NOT NULL column
+        indexes = self.get_table_indexes(table_name)
+        alterations = []
+        bbox_index = 'sx_{}_bbox_geometry'.format(table_name)
+        if bbox_index not in indexes:
+            alterations.append('MODIFY bbox_geometry GEOMETRY NOT NULL')
+            alterations.append('ADD SPATIAL INDEX `{}` (bbox_geometry)'.format(bbox_index))
+        shape_index = 'sx_{}_shape_geometry'.format(table_name)
+        if shape_index not in indexes:
+            alterations.append('ADD SPATIAL INDEX `{}` (shape_geometry)'.format(shape_index))
+        if 0 < len(alterations):
+            stmt = sqlalchemy.text('ALTER TABLE `{}` {}'.format(table_name, ', '.join(alterations)))
+            self.__session.execute(stmt)
+        return rows_count
+
+    def create_rebuild_table(self, table):
+        """Create an empty copy of a table under a temporary name, to be
+        filled and swapped with the table by replace_table."""
+        rebuild_table = table.tometadata( sqlalchemy.MetaData()
+                                        , name='{}_rebuild'.format(table.name))
+        connection = self.__session.connection()
+        rebuild_table.drop(connection, checkfirst=True)
+        rebuild_table.create(connection)
+        return rebuild_table
+
+    def replace_table(self, table, rebuild_table):
+        """Swap a table with its rebuilt copy. Readers keep using the
+        previous content until the atomic RENAME TABLE."""
+        connection = self.__session.connection()
+        if self.__engine.dialect.has_table(connection, table.name):
+            old_name = '{}_old'.format(table.name)
+            stmt = 'RENAME TABLE `{0}` TO `{1}`, `{2}` TO `{0}`'
+            stmt = stmt.format(table.name, old_name, rebuild_table.name)
+            self.__session.execute(sqlalchemy.text(stmt))
+            stmt = 'DROP TABLE `{}`'.format(old_name)
+            self.__session.execute(sqlalchemy.text(stmt))
+        else:
+            stmt = 'RENAME TABLE `{}` TO `{}`'.format(rebuild_table.name, table.name)
+            self.__session.execute(sqlalchemy.text(stmt))
+        self.catalog.invalidate()
+
+    def rebuild_availability(self, product_id):
+        """(Re)create the daily availability table of a product from the
+        datasets already registered in the database.
+
+        The table is rebuilt under a temporary name, requests read the
+        previous availability until it is replaced. Call it within
+        lock_product so that no dataset is added in the meantime."""
+        availability_cls = self.get_availability_table(product_id)
+        rebuild_table = self.create_rebuild_table(availability_cls.__table__)
+
+        dataset_cls = self.get_product_table(product_id)
+        nb_datasets = func.count(dataset_cls.dataset_name)
+        dataset_begin = sqlalchemy.func.date(dataset_cls.begin_datetime)
+        dataset_end = sqlalchemy.func.date(dataset_cls.end_datetime)
+        q = self.__session.query(nb_datasets, dataset_begin, dataset_end)
+        q = q.group_by(dataset_begin, dataset_end)
+        product_availability = q.all()
+        if 0 >= len(product_availability):
+            self.replace_table(availability_cls.__table__, rebuild_table)
+            return 0
+
+        availability = syntool_metadata.availability.DayAvailability(1)
+        arities, starts, stops = zip(*product_availability)
+        availability.add_ranges( 0, arities
+                               , syntool_metadata.availability.to_days(starts)
+                               , syntool_metadata.availability.to_days(stops))
+        first_day, counts, _ = availability.get_counts()
+        days = numpy.flatnonzero(0 < counts[0])
+        epoch = datetime.date(1970, 1, 1)
+        rows = [{'day': epoch + datetime.timedelta(days=int(first_day + i)),
+                 'datasets': int(counts[0][i])} for i in days]
+        self.__session.execute(rebuild_table.insert(), rows)
+        self.replace_table(availability_cls.__table__, rebuild_table)
+        return len(rows)
+
+    def list_datasets(self, product_id):
+        """Return the name and relative path of all the datasets of a
+        product."""
+        dataset_cls = self.get_product_table(product_id)
+        q = self.__session.query(dataset_cls.dataset_name, dataset_cls.relative_path)
+        return q.all()
+
     def get_image_info(self, product_id, dataset_id):
         """ """
         dataset_cls = self.get_product_table(product_id)
@@ -197,8 +832,7 @@ class Storage(object):
 
     def get_availability(self, year, month, day, bbox_text, requested_products, patterns, client_availability):
 	""" """
-        insp = reflection.Inspector.from_engine(self.__engine)
-        existing_tables = insp.get_table_names()
+        existing_tables = self.get_existing_tables()
         products = [p for p in requested_products
                     if (client_availability is not None and p in client_availability)
                     or Storage.get_product_table_name(p) in existing_tables]
@@ -223,78 +857,42 @@ class Storage(object):
             date_start = datetime.date(year, month, day)
             date_stop = date_start + datetime.timedelta(days=1)
 
-	# Spatial filter
-        bbox_polygon = None
-	if bbox_text is not None:
-            west, south, east, north = bbox_text.split(',')
-            bbox_polygon = 'POLYGON(({} {}, {} {}, {} {}, {} {}, {} {}))'
-	    bbox_polygon = bbox_polygon.format(west, north, east, north, east, south, west, south, west, north)
-
-        result = { 'years': {}
-                 , 'months': {}
-                 , 'days': {}
-                 }
+        # Spatial filter
+        bbox_polygon = Storage.get_bbox_polygon(bbox_text)
 
-        def update_availability(result, tkey, ttype, arity, product_index):
-	    """ """
-	    if tkey not in result[ttype]:
-	        result[ttype][tkey] = { 'datasets': arity
-				  , 'products': [product_index]}
-	    else:
-	        result[ttype][tkey]['datasets'] += arity
-	        if product_index not in result[ttype][tkey]['products']:
-		    result[ttype][tkey]['products'].append(product_index)
-
-        all_days = []
-        product_index = 0
-	for product_id in products:
-            product_index = product_index + 1
+        def query_product(product_id):
             pattern = None
             if patterns is not None:
                 pattern = patterns.get(product_id, None)
-            if client_availability is not None:
-                client_product_availability = client_availability.get(product_id, [])
-            else:
-                client_product_availability = []
+
+            availability_table_name = Storage.get_availability_table_name(product_id)
+            if pattern is None and bbox_polygon is None \
+            and availability_table_name in existing_tables:
+                # Read the daily availability maintained at ingestion
+                return 'days', self.get_daily_availability(product_id)
             product_availability = self.get_product_availability(product_id, date_start, date_stop, bbox_polygon, pattern)
+            return 'ranges', product_availability
+
+        availability = syntool_metadata.availability.DayAvailability(len(products))
+        products_availability = self.map_products(query_product, products)
+        for product_index, product_id in enumerate(products):
+            kind, product_availability = products_availability[product_index]
+            if 'days' == kind:
+                days, arities = product_availability
+                availability.add_days(product_index, arities, days)
+            elif 0 < len(product_availability):
+                arities, starts, stops = zip(*product_availability)
+                availability.add_ranges( product_index, arities
+                                       , syntool_metadata.availability.to_days(starts)
+                                       , syntool_metadata.availability.to_days(stops))
 
-            product_all_days = []
-	    for arity, start, stop in product_availability:
-                while start <= stop:
-                    product_all_days.append((start.year, start.month, start.day))
-		    update_availability(result, start.year, 'years', arity, product_index)
-                    if start.year == year:
-                        update_availability(result, start.month, 'months', arity, product_index)
-                        if start.month == month:
-                            update_availability(result, start.day, 'days', arity, product_index)
-
-		    start = start + datetime.timedelta(days=1)
-
-            for arity, start in client_product_availability:
-                product_all_days.append((start.year, start.month, start.day))
-                update_availability(result, start.year, 'years', arity, product_index)
-                if start.year == year:
-                    update_availability(result, start.month, 'months', arity, product_index)
-                    if start.month == month:
-                        update_availability(result, start.day, 'days', arity, product_index)
-            all_days.append(set(product_all_days))
-
-        coloc_days = set.intersection(*all_days)
-        coloc_years = set([x[0] for x in coloc_days])
-        coloc_months = set([x[1] for x in coloc_days if x[0] == year])
-
-        for y in result['years']:
-            if y in coloc_years:
-                result['years'][y]['coloc'] = products
-            else:
-                result['years'][y]['coloc'] = []
-        for m in result['months']:
-            if m in coloc_months:
-                result['months'][m]['coloc'] = products
-            else:
-                result['months'][m]['coloc'] = []
+            if client_availability is not None:
+                client_product_availability = client_availability.get(product_id, None)
+                if client_product_availability is not None:
+                    days, arities = client_product_availability
+                    availability.add_days(product_index, arities, days)
 
-	return result
+        return availability.summarize(year, month, products)
 
     @staticmethod
     def format_dataset(product_id, product_type, data_url, data_path, dataset):
@@ -346,21 +944,9 @@ class Storage(object):
 	    uri = dataset_uri
 	# DRIFT? USER?
 
-        features = []
-	features_dir = os.path.join(data_path, 'ingested', product_id,
-                                    dataset.relative_path, dataset_name,
-                                    'features')
-        if os.path.isdir(features_dir):
-            ini_parser = ConfigParser.ConfigParser()
-	    for root, dirs, files in os.walk(features_dir):
-                for ini_path in [os.path.join(root, fn) for fn in files if fn.lower().endswith('.ini')]:
-                    ini_parser.read(ini_path)
-                    feature = dict(ini_parser._sections)
-                    for k in feature:
-                        feature[k].pop('__name__', None)
-		    if 'POLYGON' == feature['global'].get('display_type', None):
-                        feature['polygon'] = feature['polygon_EPSG3857'].values()
-		    features.append(feature)
+        dataset_dir = os.path.join(data_path, 'ingested', product_id,
+                                   dataset.relative_path, dataset_name)
+        features = syntool_metadata.features.get_features(dataset_dir)
 
         return { 'productId': product_id
                , 'datasetId': '{}-{}'.format(product_id, dataset_name)
@@ -384,25 +970,40 @@ class Storage(object):
                }
 
     def get_datasets( self, data_url, data_path
-		    , start, stop, bbox_text, requested_products, patterns, results_limit):
+		    , start, stop, bbox_text, requested_products, patterns, results_limit
+                    , global_order=False):
         """ """
-        insp = reflection.Inspector.from_engine(self.__engine)
-        existing_tables = insp.get_table_names()
+        return list(self.iter_datasets( data_url, data_path, start, stop
+                                      , bbox_text, requested_products, patterns
+                                      , results_limit, global_order))
+
+    def iter_datasets( self, data_url, data_path
+                     , start, stop, bbox_text, requested_products, patterns, results_limit
+                     , global_order=False):
+        """Generate the formatted datasets matching the request.
+
+        Rows are fetched with a server-side cursor and formatted one at a
+        time, so the generator must be consumed before the session is
+        closed."""
+        existing_tables = self.get_existing_tables()
         products = [ p for p in requested_products if Storage.get_product_table_name(p) in existing_tables ]
 
+        if global_order is True:
+            for dataset in self.iter_datasets_by_time( data_url, data_path
+                                                     , start, stop, bbox_text
+                                                     , products, patterns
+                                                     , results_limit):
+                yield dataset
+            return
+
         # Spatial filter
-        bbox_polygon = None
-        if bbox_text is not None:
-            west, south, east, north = bbox_text.split(',')
-            bbox_polygon = 'POLYGON(({} {}, {} {}, {} {}, {} {}, {} {}))'
-            bbox_polygon = bbox_polygon.format(west, north, east, north, east, south, west, south, west, north)
+        bbox_polygon = Storage.get_bbox_polygon(bbox_text)
 
-        result = []
         bucket_size = results_limit
         for product_id in products:
             if 0 >= bucket_size:
                 break
-            product_type = self.__session.query(Product.type).filter(Product.product_id==product_id).first()[0]
+            product_type = self.get_product_type(product_id)
 
             pattern = None
             if patterns is not None:
@@ -413,60 +1014,104 @@ class Storage(object):
             q = q.filter(dataset_cls.begin_datetime < stop)
             q = q.filter(dataset_cls.end_datetime > start)
             if bbox_polygon is not None:
-                q = q.filter(sqlalchemy.or_(dataset_cls.shape_text=='POINT(0 0)', func.Intersects(dataset_cls.shape_geometry, func.GeomFromText(bbox_polygon))))
+                q = q.filter(Storage.get_extent_filter(dataset_cls, bbox_polygon))
 
             if pattern is not None:
-                q = q.filter(dataset_cls.dataset_name.like('%{}%'.format(pattern)))
+                q = q.filter(self.get_pattern_filter(product_id, dataset_cls, pattern))
             q = q.order_by(dataset_cls.begin_datetime)
             q = q.limit(bucket_size)
-            product_datasets = map(lambda x: Storage.format_dataset(product_id, product_type, data_url, data_path, x), q.all())
-            bucket_size = bucket_size - len(product_datasets)
-	    result.extend(product_datasets)
-        return result
-
-
-    def search_datasets( self, start, stop, bbox_text, requested_products, patterns):
-        """ """
-        insp = reflection.Inspector.from_engine(self.__engine)
-        existing_tables = insp.get_table_names()
-        products = [ p for p in requested_products if Storage.get_product_table_name(p) in existing_tables ] 
-        
-	# Spatial filter
-        bbox_polygon = None
-	if bbox_text is not None:
-            west, south, east, north = bbox_text.split(',')
-            bbox_polygon = 'POLYGON(({} {}, {} {}, {} {}, {} {}, {} {}))'
-	    bbox_polygon = bbox_polygon.format(west, north, east, north, east, south, west, south, west, north)
-
-	results = {}
+            for dataset in q.yield_per(STREAM_BATCH_SIZE):
+                bucket_size = bucket_size - 1
+                yield Storage.format_dataset(product_id, product_type, data_url, data_path, dataset)
+
+    def iter_datasets_by_time( self, data_url, data_path, start, stop, bbox_text
+                             , products, patterns, results_limit):
+        """Retrieve the datasets of all products with a single UNION ALL
+        query, ordered by begin datetime across products and limited to
+        results_limit datasets overall."""
+        bbox_polygon = Storage.get_bbox_polygon(bbox_text)
+
+        queries = []
+        for product_id in products:
+            product_type = self.get_product_type(product_id)
 
-	for product_id in products:
             pattern = None
             if patterns is not None:
                 pattern = patterns.get(product_id, None)
-	    
+
             dataset_cls = self.get_product_table(product_id)
-            q = self.__session.query(dataset_cls.dataset_name)
-            q = q.filter(dataset_cls.begin_datetime < stop)
-            q = q.filter(dataset_cls.end_datetime > start)
+            q = sqlalchemy.select([ sqlalchemy.literal(product_id).label('product_id')
+                                  , sqlalchemy.literal(product_type).label('product_type')
+                                  , dataset_cls.dataset_name
+                                  , dataset_cls.relative_path
+                                  , dataset_cls.begin_datetime
+                                  , dataset_cls.end_datetime
+                                  , dataset_cls.min_zoom_level
+                                  , dataset_cls.max_zoom_level
+                                  , dataset_cls.resolutions
+                                  , dataset_cls.bbox_text
+                                  , dataset_cls.shape_text])
+            q = q.where(dataset_cls.begin_datetime < stop)
+            q = q.where(dataset_cls.end_datetime > start)
             if bbox_polygon is not None:
-                q = q.filter(sqlalchemy.or_(dataset_cls.shape_text=='POINT(0 0)', func.Intersects(dataset_cls.shape_geometry, func.GeomFromText(bbox_polygon))))
-
+                q = q.where(Storage.get_extent_filter(dataset_cls, bbox_polygon))
             if pattern is not None:
-                q = q.filter(dataset_cls.dataset_name.like('%{}%'.format(pattern)))
-            q = q.order_by(dataset_cls.begin_datetime)
-            results[product_id] = map(lambda x: x[0], q.all())
-        return results
+                q = q.where(self.get_pattern_filter(product_id, dataset_cls, pattern))
+            # Limit each product first so that the global sort only has to
+            # merge results_limit rows per product
+            q = q.order_by(dataset_cls.begin_datetime).limit(results_limit).alias()
+            queries.append(sqlalchemy.select([q]))
+
+        if 0 >= len(queries):
+            return
+
+        q = sqlalchemy.union_all(*queries)
+        q = q.order_by(sqlalchemy.literal_column('begin_datetime'))
+        q = q.limit(results_limit)
+        q = q.execution_options(stream_results=True)
+        for x in self.__session.execute(q):
+            yield Storage.format_dataset(x.product_id, x.product_type, data_url, data_path, x)
+
+    def iter_search_datasets( self, start, stop, bbox_text, requested_products, patterns):
+        """Generate (product_id, dataset_name) tuples for the matching
+        datasets, read through a server-side cursor."""
+        existing_tables = self.get_existing_tables()
+        products = [ p for p in requested_products if Storage.get_product_table_name(p) in existing_tables ] 
+        
+        # Spatial filter
+        bbox_polygon = Storage.get_bbox_polygon(bbox_text)
+
+	for product_id in products:
+            q = self.get_search_query(product_id, start, stop, bbox_polygon, patterns)
+            for dataset_name, in q.yield_per(STREAM_BATCH_SIZE):
+                yield product_id, dataset_name
+
+    def get_search_query(self, product_id, start, stop, bbox_polygon, patterns):
+        """Build the query selecting the names of the datasets of a product
+        which match the search criteria."""
+        pattern = None
+        if patterns is not None:
+            pattern = patterns.get(product_id, None)
+
+        dataset_cls = self.get_product_table(product_id)
+        q = self.__session.query(dataset_cls.dataset_name)
+        q = q.filter(dataset_cls.begin_datetime < stop)
+        q = q.filter(dataset_cls.end_datetime > start)
+        if bbox_polygon is not None:
+            q = q.filter(Storage.get_extent_filter(dataset_cls, bbox_polygon))
+
+        if pattern is not None:
+            q = q.filter(self.get_pattern_filter(product_id, dataset_cls, pattern))
+        return q.order_by(dataset_cls.begin_datetime)
 
     def list_products(self, **kwargs):
-        insp = reflection.Inspector.from_engine(self.__engine)
-        existing_tables = insp.get_table_names()
-        if 'products' not in existing_tables:
+        catalog = self.get_catalog()
+        if 'products' not in catalog.tables:
             Product.__table__.create(self.__engine, checkfirst=True)
             self.__session.commit()
-        q = self.__session.query(Product.product_id, Product.shortname)
-        results = { k:v for k,v in q.all() }
-        return results
+            self.catalog.invalidate()
+            return {}
+        return dict(catalog.shortnames)
 
     def get_product_availability( self, product_id, date_start, date_stop, bbox, pattern):
         """ """
@@ -475,8 +1120,7 @@ class Storage(object):
                     "DATE_FORMAT(end_datetime, '%Y/%m/%d') AS end_datetime2 FROM `product_" + productId.replace(' ', '_') + "` " \
                     "GROUP BY begin_datetime2, end_datetime2"
         """
-        insp = reflection.Inspector.from_engine(self.__engine)
-        existing_tables = insp.get_table_names()
+        existing_tables = self.get_existing_tables()
         table_name = Storage.get_product_table_name(product_id)
         if table_name not in existing_tables:
             return []
@@ -487,68 +1131,83 @@ class Storage(object):
         q = self.__session.query(nb_datasets, dataset_begin, dataset_end)
 
         if bbox is not None:
-            q = q.filter(sqlalchemy.or_(dataset_cls.shape_text=='POINT(0 0)', func.Intersects(dataset_cls.shape_geometry, func.GeomFromText(bbox))))
+            q = q.filter(Storage.get_extent_filter(dataset_cls, bbox))
 
         if pattern is not None:
-            q = q.filter(dataset_cls.dataset_name.like('%{}%'.format(pattern)))
+            q = q.filter(self.get_pattern_filter(product_id, dataset_cls, pattern))
 
         q = q.group_by( dataset_begin, dataset_end)
         return q.all()
 
+    def get_daily_availability(self, product_id):
+        """Return the days (since 1970-01-01) covered by the datasets of a
+        product and the number of datasets for each of these days."""
+        availability_cls = self.get_availability_table(product_id)
+        q = self.__session.query(availability_cls.day, availability_cls.datasets)
+        q = q.filter(availability_cls.datasets > 0)
+        rows = q.all()
+        if 0 >= len(rows):
+            return [], []
+        days, arities = zip(*rows)
+        return syntool_metadata.availability.to_days(days), arities
+
     def find_nearest(self, direction, current, bbox_text, requested_products, patterns, search_step=60):
         """ """
-        insp = reflection.Inspector.from_engine(self.__engine)
-        existing_tables = insp.get_table_names()
-        products = [ p for p in requested_products if Storage.get_product_table_name(p) in existing_tables ] 
+        existing_tables = self.get_existing_tables()
+        products = [ p for p in requested_products if Storage.get_product_table_name(p) in existing_tables ]
 
-	# Spatial filter
-        bbox_polygon = None
-	if bbox_text is not None:
-            west, south, east, north = bbox_text.split(',')
-            bbox_polygon = 'POLYGON(({} {}, {} {}, {} {}, {} {}, {} {}))'
-	    bbox_polygon = bbox_polygon.format(west, north, east, north, east, south, west, south, west, north)
+        # Spatial filter
+        bbox_polygon = Storage.get_bbox_polygon(bbox_text)
 
-        after_delta = float('inf')
-        before_delta = float('inf')
-	for product_id in products:
+        current_ts = calendar.timegm(current.timetuple())
+
+        # Nearest datasets before and after the current time for each product,
+        # all resolved in a single query.
+        queries = []
+        for product_id in products:
             pattern = None
             if patterns is not None:
                 pattern = patterns.get(product_id, None)
 
             dataset_cls = self.get_product_table(product_id)
+            mid_ts = Storage.get_mid_timestamp(dataset_cls)
 
-            mid_ts = ((func.unix_timestamp(dataset_cls.begin_datetime) + func.unix_timestamp(dataset_cls.end_datetime)) / 2).label('mid_ts')
-            current_ts = calendar.timegm(current.timetuple())
+            filters = []
+            if bbox_polygon is not None:
+                filters.append(Storage.get_extent_filter(dataset_cls, bbox_polygon))
+            if pattern is not None:
+                filters.append(self.get_pattern_filter(product_id, dataset_cls, pattern))
 
             # Look for datasets in the future
             if direction in ['nearest', 'after', None]:
-                q = self.__session.query(mid_ts)
-                q = q.filter(mid_ts > current_ts + search_step)
-                if bbox_polygon is not None:
-                    q = q.filter(sqlalchemy.or_(dataset_cls.shape_text=='POINT(0 0)', func.Intersects(dataset_cls.shape_geometry, func.GeomFromText(bbox_polygon))))
-                if pattern is not None:
-                    q = q.filter(dataset_cls.dataset_name.like('%{}%'.format(pattern)))
-                q = q.order_by(mid_ts)
-                q = q.limit(1)
-		result = q.first()
-                if result is not None:
-                    delta = int(result[0]) - current_ts
+                q = sqlalchemy.select([mid_ts.label('mid_ts')])
+                q = q.where(mid_ts > current_ts + search_step)
+                for f in filters:
+                    q = q.where(f)
+                q = q.order_by(mid_ts).limit(1).alias()
+                queries.append(sqlalchemy.select([sqlalchemy.literal('after').label('direction'), q.c.mid_ts]))
+
+            # Look for datasets in the past
+            if direction in ['nearest', 'before', None]:
+                q = sqlalchemy.select([mid_ts.label('mid_ts')])
+                q = q.where(mid_ts < current_ts - search_step)
+                for f in filters:
+                    q = q.where(f)
+                q = q.order_by(desc(mid_ts)).limit(1).alias()
+                queries.append(sqlalchemy.select([sqlalchemy.literal('before').label('direction'), q.c.mid_ts]))
+
+        after_delta = float('inf')
+        before_delta = float('inf')
+        if 0 < len(queries):
+            for result_direction, result_ts in self.__session.execute(sqlalchemy.union_all(*queries)):
+                if result_ts is None:
+                    continue
+                if 'after' == result_direction:
+                    delta = int(result_ts) - current_ts
                     if delta < after_delta:
                         after_delta = delta
-
-	    # Look for datasets in the past
-            if direction in ['nearest', 'before', None]:
-                q = self.__session.query(mid_ts)
-                q = q.filter(mid_ts < current_ts - search_step)
-                if bbox_polygon is not None:
-                    q = q.filter(sqlalchemy.or_(dataset_cls.shape_text=='POINT(0 0)', func.Intersects(dataset_cls.shape_geometry, func.GeomFromText(bbox_polygon))))
-                if pattern is not None:
-                    q = q.filter(dataset_cls.dataset_name.like('%{}%'.format(pattern)))
-                q = q.order_by(desc(mid_ts))
-                q = q.limit(1)
-                result = q.first()
-                if result is not None:
-                    delta = current_ts - int(result[0])
+                else:
+                    delta = current_ts - int(result_ts)
                     if delta < before_delta:
                         before_delta = delta
 
@@ -565,4 +1224,4 @@ class Storage(object):
         if after_delta == float('inf'):
             after_delta = -1
 
-	return new_ts, before_delta, after_delta
+        return new_ts, before_delta, after_delta
@@ -27,26 +27,59 @@ import sys
 import PIL
 import PIL.Image
 import math
-try:
-    import simplejson as json
-except ImportError:
-    import json
 import errno
 import numpy
 import tarfile
+import zipfile
+import StringIO
 import logging
 import tempfile
-try:
-    import subprocess32 as subprocess
-except ImportError:
-    import subprocess
-import xml.etree.ElementTree
+import time
+import Queue
+import itertools
+import multiprocessing
+import multiprocessing.pool
+import threading
+import syntool_metadata.cache
+import syntool_metadata.georef
+import syntool_metadata.tiles
+import syntool_metadata.tilemap
 
 logger = logging.getLogger(__name__)
 
+TILE_SIZE = 256
+# Number of processes which compose the datasets of the extractions
+DEFAULT_WORKERS = 1
+# Number of threads which decode the tiles of a dataset
+DEFAULT_DECODE_THREADS = 4
+# Memory (in bytes) used by each extraction process to keep decoded tiles
+# and images, the pool holds DEFAULT_WORKERS times these caches
+DEFAULT_WORKER_TILE_CACHE_BYTES = 64 * 1024 * 1024
+DEFAULT_WORKER_IMAGE_CACHE_BYTES = 64 * 1024 * 1024
+# Bytes per pixel of the largest image modes (RGBA, I, F)
+MAX_PIXEL_SIZE = 4
+# Entry added to streamed archives which could not be completed
+ERROR_ENTRY_NAME = 'ERROR.txt'
+# Archive formats supported by stream, with their tarfile mode
+ARCHIVE_FORMATS = { 'tgz': 'w|gz'
+                  , 'tar': 'w|'
+                  , 'zip': None
+                  }
+
+# Pool of processes shared by all the extractions of this process, created
+# on first use (i.e. after the WSGI server has forked its workers)
+pool = None
+pool_lock = threading.Lock()
+# Sizes of the caches of the pool processes, read when the pool is created
+worker_tile_cache_bytes = DEFAULT_WORKER_TILE_CACHE_BYTES
+worker_image_cache_bytes = DEFAULT_WORKER_IMAGE_CACHE_BYTES
+
 class ProductNotAvailableException(Exception):
     pass
 
+class ExtractionTooLargeException(Exception):
+    pass
+
 def sign(x):
     """ """
     if x > 0.0:
@@ -59,94 +92,31 @@ def clamp(minimum, x, maximum):
     """ """
     return max(minimum, min(x, maximum))
 
-def get_zxy_info(root_dir, product_id, dataset_id, min_resolution):
+def get_zxy_info(root_dir, product_id, dataset_id, min_resolution, tolerance=1.0):
     """ """
     product_dir = os.path.join(root_dir, 'ingested', product_id)
     dataset_dir = os.path.join(root_dir, 'ingested', product_id, dataset_id)
     tile_dir = os.path.join(dataset_dir, 'tiles.zxy')
-    metadata_file = os.path.join(dataset_dir, 'metadata.json')
-    json_tile_file = os.path.join(tile_dir, 'tilemap.json')
-    xml_tile_file = os.path.join(tile_dir, 'tilemap.xml')
 
     if not os.path.exists(product_dir):
         raise ProductNotAvailableException(product_id)
 
-    if os.path.exists(metadata_file):
-        with open(metadata_file, 'r') as json_file:
-            json_data = json.load(json_file)
-	    point0, _, point2, _, _ = json_data['bbox_str'][9:-2].split(',')
-            resolutions = { int(x[0]):float(x[1]) for x in map(lambda y: y.split(':'), json_data['resolutions'])}
-            epsg = json_data['syntool_id'].split('_', 1)[0]
-
-	if epsg in ['900913', '3857']:
-            world_origin = numpy.array([-20037508.34, 20037508.34])
-        elif '3413' == epsg:
-            world_origin = numpy.array([-5000000, 11384000])
-        else:
-            raise Exception('Unsupported epsg: {}'.format(epsg))
-
-        west, north = map(float, point0.split(' '))
-        east, south = map(float, point2.split(' '))
-        width = east - west
-        height = north - south
-        origin = numpy.array([west, south])
-        for zoom_level, resolution in resolutions.iteritems():
-            if resolution <= min_resolution:
-                min_resolution = resolution
-                break
-
-    elif os.path.exists(json_tile_file):
-        with open(json_tile_file, 'r') as json_file:
-            json_data = json.load(json_file)
-        world_origin = numpy.array(json_data["tiles"]["origin"])
-
-        min_x, min_y, max_x, max_y = json_data["bbox"]
-        origin = numpy.array([min_x, min_y])
-        width = max_x - min_x
-        height = max_y - min_y
-
-        for zoom_level in sorted(json_data["tilesets"], key=lambda x: int(x)):
-            resolution = json_data['tilesets'][zoom_level]["units_per_pixel"]
-            zoom_level = int(zoom_level)
-            if resolution <= min_resolution:
-                min_resolution = resolution
-                break
-
-    elif os.path.exists(xml_tile_file):
-        tree = xml.etree.ElementTree.parse(xml_tile_file)
-        root = tree.getroot()
-        origin_node = root.findall(".//Origin")[0]
-        world_origin_x = float(origin_node.attrib['x'])
-        world_origin_y = float(origin_node.attrib['y'])
-        world_origin = numpy.array([world_origin_x, world_origin_y])
-        bbox_node = root.findall(".//BoundingBox")[0]
-        min_x = float(bbox_node.attrib['minx'])
-        max_x = float(bbox_node.attrib['maxx'])
-        min_y = float(bbox_node.attrib['miny'])
-        max_y = float(bbox_node.attrib['maxy'])
-        origin = numpy.array([min_x, min_y])
-        width = max_x - min_x
-        height = max_y - min_y
-        tile_set_nodes = root.findall(".//TileSet")
-        for tile_set_node in tile_set_nodes:
-            resolution = float(tile_set_node.attrib["units-per-pixel"])
-            zoom_level = int(tile_set_node.attrib["order"])
-            if resolution <= min_resolution:
-                min_resolution = resolution
-                break
-    else:
-        raise Exception('Tilemap (json or xml) not found in "{}"'.format(tile_dir))
+    tilemap = syntool_metadata.tilemap.get_tilemap(root_dir, product_id,
+                                                   dataset_id)
+    zoom_level, resolution = tilemap.select_zoom_level(min_resolution,
+                                                       tolerance)
+    min_resolution = min(min_resolution, resolution)
 
     return { 'product_id': product_id
            , 'dataset_id': dataset_id
            , 'type': 'ZXY'
            , 'resolution': resolution
            , "zoom_level": zoom_level
-           , "origin": origin
-           , "world_origin": world_origin
+           , "origin": numpy.array(tilemap.origin)
+           , "world_origin": numpy.array(tilemap.world_origin)
            , "tile_dir": tile_dir
-           , "width": width
-           , "height": height
+           , "width": tilemap.width
+           , "height": tilemap.height
            }, min_resolution
 
 def get_image_info( root_dir, product_id, dataset_id, min_resolution
@@ -155,8 +125,7 @@ def get_image_info( root_dir, product_id, dataset_id, min_resolution
     west, north, east, south = db_storage.get_image_info(product_id, dataset_id)
     image_dir = os.path.join(root_dir, 'ingested', product_id, dataset_id)
     image_path = os.path.join(image_dir, 'imageLayer.png')
-    image = PIL.Image.open(image_path, 'r')
-    width, height = image.size
+    width, height = syntool_metadata.tiles.get_image_dimensions(image_path)
     resolution = (east - west) / width
     if resolution < min_resolution:
         min_resolution = resolution
@@ -173,10 +142,10 @@ def get_image_info( root_dir, product_id, dataset_id, min_resolution
            , 'image_dir': image_dir
            }, min_resolution
 
-def get_dataset_info(root_dir, min_resolution, product_id, dataset_id, dataset_type, db_storage):
+def get_dataset_info(root_dir, min_resolution, product_id, dataset_id, dataset_type, db_storage, tolerance=1.0):
     """ """
     if 'ZXY' == dataset_type:
-        return get_zxy_info(root_dir, product_id, dataset_id, min_resolution)
+        return get_zxy_info(root_dir, product_id, dataset_id, min_resolution, tolerance)
     elif 'IMAGE' == dataset_type:
         return get_image_info( root_dir
                              , product_id
@@ -188,9 +157,29 @@ def get_dataset_info(root_dir, min_resolution, product_id, dataset_id, dataset_t
         raise Exception('TMS not supported anymore')
     raise Exception('"{}" type not supported'.format(dataset_type))
 
-def get_data_from_zxy(dataset, tile_size, min_resolution, x1, y1, x2, y2):
-    """ """
-    origin = dataset["origin"]
+def get_tiles(tile_paths, decode_threads):
+    """Decode tiles, on a pool of decode_threads threads if there are more
+    than one (PIL releases the GIL while decoding)."""
+    if 1 >= decode_threads or 1 >= len(tile_paths):
+        return map(syntool_metadata.tiles.get_tile, tile_paths)
+    pool = multiprocessing.pool.ThreadPool(min(decode_threads, len(tile_paths)))
+    try:
+        return pool.map(syntool_metadata.tiles.get_tile, tile_paths)
+    finally:
+        pool.close()
+        pool.join()
+
+def get_data_from_zxy( dataset, tile_size, min_resolution, x1, y1, x2, y2
+                     , decode_threads=DEFAULT_DECODE_THREADS):
+    """Compose the image of a ZXY dataset for the (x1, y1, x2, y2) area at
+    min_resolution.
+
+    Each tile is cropped to the part which overlaps the area and resampled
+    directly into the output image, so memory use stays close to the size
+    of the output. Tiles are padded with the pixels of their neighbours
+    before being resampled so that interpolation does not stop at tile
+    borders: they are decoded row after row and only three rows are kept
+    in memory."""
     world_origin = dataset["world_origin"]
     resolution = dataset["resolution"]
     zoom_level = dataset["zoom_level"]
@@ -212,75 +201,246 @@ def get_data_from_zxy(dataset, tile_size, min_resolution, x1, y1, x2, y2):
     intX2 = int(intX2)
     intY2 = int(intY2)
 
-    dataset_width = (intX2 - intX1 + 1) * tile_size
-    dataset_height = (intY1 - intY2 + 1) * tile_size
-    dataset_image = None
+    image_width = int(round((x2 - x1) / min_resolution))
+    image_height = int(round((y2 - y1) / min_resolution))
+    tile_extent = tile_size * resolution
+
+    def to_columns(x):
+        return clamp(0, int(round((x - x1) / min_resolution)), image_width)
+
+    def to_rows(y):
+        return clamp(0, int(round((y2 - y) / min_resolution)), image_height)
 
-    i = 0
-    j = 0
+    manifest = syntool_metadata.tiles.get_manifest(tile_dir)
+
+    # Output window of each tile and the matching box in tile pixels
+    tile_windows = {}
     for intX in range(intX1, intX2 + 1):
+        tile_west = world_origin[0] + intX * tile_extent
+        col1 = to_columns(tile_west)
+        col2 = to_columns(tile_west + tile_extent)
+        if col2 <= col1:
+            continue
+        left = (x1 + col1 * min_resolution - tile_west) / resolution
+        right = (x1 + col2 * min_resolution - tile_west) / resolution
         for intY in range(intY2, intY1 + 1):
-            tile_relpath = "%i/%i/%i.png" % (zoom_level, intX, intY)
-            tile_path = os.path.join(tile_dir, tile_relpath)
-            if os.path.exists(tile_path):
-                tile_image = PIL.Image.open(tile_path, "r")
-                if dataset_image is None:
-                    image_mode = tile_image.mode
-                    image_palette = tile_image.palette
-                    dataset_image = PIL.Image.new(image_mode, (dataset_width, dataset_height))
-                dataset_image.paste(tile_image, (i * tile_size, j * tile_size))
-            j = j + 1
-        i = i + 1
-        j = 0
+            if not syntool_metadata.tiles.has_tile(manifest, zoom_level, intX, intY):
+                continue
+            tile_north = world_origin[1] - intY * tile_extent
+            row1 = to_rows(tile_north)
+            row2 = to_rows(tile_north - tile_extent)
+            if row2 <= row1:
+                continue
+            upper = (tile_north - (y2 - row1 * min_resolution)) / resolution
+            lower = (tile_north - (y2 - row2 * min_resolution)) / resolution
+            box = ( clamp(0, left, tile_size), clamp(0, upper, tile_size)
+                  , clamp(0, right, tile_size), clamp(0, lower, tile_size))
+            tile_windows.setdefault(intY, []).append((intX, (col1, row1, col2, row2), box))
+
+    if 0 >= len(tile_windows):
+        return (None, None, None, None, None)
+
+    # Source pixels read by the bilinear filter beyond the box of a tile
+    scale = float(min_resolution) / resolution
+    pad = min(tile_size, int(math.ceil(max(1.0, scale))) + 1)
+
+    def get_row_tiles(intY):
+        """Decode the tiles of a row, including the columns on each side of
+        the area which are only used for padding."""
+        columns = [intX for intX in range(intX1 - 1, intX2 + 2)
+                   if syntool_metadata.tiles.has_tile(manifest, zoom_level, intX, intY)]
+        tile_paths = [os.path.join(tile_dir, "%i/%i/%i.png" % (zoom_level, intX, intY))
+                      for intX in columns]
+        tile_images = get_tiles(tile_paths, decode_threads)
+        return dict([(intX, tile_image) for intX, tile_image in zip(columns, tile_images)
+                     if tile_image is not None])
+
+    dataset_image = None
+    image_mode = None
+    image_palette = None
+    rows = {intY2 - 1: get_row_tiles(intY2 - 1), intY2: get_row_tiles(intY2)}
+    for intY in range(intY2, intY1 + 1):
+        rows[intY + 1] = get_row_tiles(intY + 1)
+        rows.pop(intY - 2, None)
+        for intX, (col1, row1, col2, row2), box in tile_windows.get(intY, []):
+            tile_image = rows[intY].get(intX, None)
+            if tile_image is None:
+                continue
+            if dataset_image is None:
+                image_mode = tile_image.mode
+                image_palette = tile_image.palette
+                dataset_image = PIL.Image.new(image_mode, (image_width, image_height))
+
+            # Tile surrounded by pad pixels of its neighbours (missing
+            # neighbours are totally transparent)
+            padded_image = PIL.Image.new(image_mode, (tile_size + 2 * pad, tile_size + 2 * pad))
+            for dy in (-1, 0, 1):
+                for dx in (-1, 0, 1):
+                    neighbour = rows[intY + dy].get(intX + dx, None)
+                    if neighbour is None:
+                        continue
+                    padded_image.paste(neighbour, (pad + dx * tile_size, pad + dy * tile_size))
+            padded_box = tuple([x + pad for x in box])
+            window_image = padded_image.resize( (col2 - col1, row2 - row1)
+                                              , PIL.Image.BILINEAR
+                                              , padded_box)
+            dataset_image.paste(window_image, (col1, row1))
 
     if dataset_image is None:
         # No tiles for this dataset (totally transparent tiles are not produced).
         return (None, None, None, None, None)
 
-    new_dataset_width = int(round(dataset_width * resolution / min_resolution))
-    new_dataset_height = int(round(dataset_height * resolution / min_resolution))
-    dataset_image = dataset_image.resize((new_dataset_width, new_dataset_height), PIL.Image.BILINEAR)
-    gx = world_origin[0] + intX1 * tile_size * resolution
-    gy = world_origin[1] - intY2 * tile_size * resolution
-    image_x = int(round((gx - x1) / min_resolution))
-    image_y = int(round((y2 - gy) / min_resolution))
-    return (dataset_image, image_x, image_y, image_mode, image_palette)
+    return (dataset_image, 0, 0, image_mode, image_palette)
 
 def get_data_from_image(dataset, min_resolution, x1, y1, x2, y2):
+    """Compose the image of an IMAGE dataset for the (x1, y1, x2, y2) area
+    at min_resolution.
+
+    Only the part of the image which overlaps the area is resampled, into
+    an image the size of the output."""
     image_path = os.path.join(dataset["image_dir"], 'imageLayer.png')
-    dataset_image = PIL.Image.open(image_path, "r")
-    image_mode = dataset_image.mode
-    image_palette = dataset_image.palette
     dataset_width = dataset["width"]
     dataset_height = dataset["height"]
     resolution = dataset["resolution"]
+    image_width = int(round((x2 - x1) / min_resolution))
+    image_height = int(round((y2 - y1) / min_resolution))
+
+    # Position and size of the whole dataset image in the output
+    image_x = int(round((dataset["west"] - x1) / min_resolution))
+    image_y = int(round((y2 - dataset["north"]) / min_resolution))
     new_dataset_width = int(round(dataset_width * resolution / min_resolution))
     new_dataset_height = int(round(dataset_height * resolution / min_resolution))
-    dataset_image = dataset_image.resize((new_dataset_width, new_dataset_height), PIL.Image.BILINEAR)
-    gx = dataset["west"]
-    gy = dataset["north"]
-    image_x = int(round((gx - x1) / min_resolution))
-    image_y = int(round((y2 - gy) / min_resolution))
-    return (dataset_image, image_x, image_y, image_mode, image_palette)
-
-def get_dataset_data(dataset, tile_size, min_resolution, x1, y1, x2, y2):
+
+    col1 = clamp(0, image_x, image_width)
+    col2 = clamp(0, image_x + new_dataset_width, image_width)
+    row1 = clamp(0, image_y, image_height)
+    row2 = clamp(0, image_y + new_dataset_height, image_height)
+    if col2 <= col1 or row2 <= row1:
+        # The dataset does not overlap the area
+        return (None, None, None, None, None)
+
+    dataset_image = syntool_metadata.tiles.get_image(image_path)
+    if dataset_image is None:
+        return (None, None, None, None, None)
+    image_mode = dataset_image.mode
+    image_palette = dataset_image.palette
+
+    # Box of the source image which matches the output window
+    scale_x = float(dataset_width) / new_dataset_width
+    scale_y = float(dataset_height) / new_dataset_height
+    box = ( (col1 - image_x) * scale_x, (row1 - image_y) * scale_y
+          , (col2 - image_x) * scale_x, (row2 - image_y) * scale_y)
+    window_image = dataset_image.resize( (col2 - col1, row2 - row1)
+                                       , PIL.Image.BILINEAR
+                                       , box)
+    output_image = PIL.Image.new(image_mode, (image_width, image_height))
+    output_image.paste(window_image, (col1, row1))
+    return (output_image, 0, 0, image_mode, image_palette)
+
+def get_dataset_data( dataset, tile_size, min_resolution, x1, y1, x2, y2
+                    , decode_threads=DEFAULT_DECODE_THREADS):
     """ """
     if 'ZXY' == dataset['type']:
-        image, image_x, image_y, image_mode, image_palette = get_data_from_zxy(dataset, tile_size, min_resolution, x1, y1, x2, y2)
+        image, image_x, image_y, image_mode, image_palette = get_data_from_zxy(dataset, tile_size, min_resolution, x1, y1, x2, y2, decode_threads)
     elif 'IMAGE' == dataset['type']:
         image, image_x, image_y, image_mode, image_palette = get_data_from_image(dataset, min_resolution, x1, y1, x2, y2)
     else:
         raise Exception('"{}" type not supported'.format(dataset['type']))
     return image, image_x, image_y, image_mode, image_palette
 
-def get(root_dir, datasets_list, x1, y1, x2, y2, min_resolution, output_format, server_host, download_dir, db_storage):
-    """ """
-    TILE_SIZE = 256
+def init_worker(tile_cache_bytes, image_cache_bytes):
+    """Give each extraction process its own caches: the ones inherited from
+    the parent may have been locked by another thread when it forked.
+    Decoded tiles and images are limited to tile_cache_bytes and
+    image_cache_bytes."""
+    syntool_metadata.tiles.cache = syntool_metadata.cache.LRUCache(
+        None, tile_cache_bytes, syntool_metadata.tiles.get_image_size)
+    syntool_metadata.tiles.images = syntool_metadata.cache.LRUCache(
+        None, image_cache_bytes, syntool_metadata.tiles.get_image_size)
+    syntool_metadata.tiles.manifests = syntool_metadata.cache.LRUCache(
+        syntool_metadata.tiles.DEFAULT_MANIFEST_CACHE_SIZE)
+    syntool_metadata.tiles.dimensions = syntool_metadata.cache.LRUCache(
+        syntool_metadata.tiles.DEFAULT_DIMENSIONS_CACHE_SIZE)
+    syntool_metadata.tilemap.cache = syntool_metadata.cache.LRUCache(
+        syntool_metadata.tilemap.DEFAULT_CACHE_SIZE)
+
+def run_task(task):
+    """Call render_dataset in a pool process and return (result, None), or
+    (None, exception) if it failed: the callback of apply_async is not
+    called for failed tasks."""
+    try:
+        return render_dataset(task), None
+    except Exception:
+        _, e, _ = sys.exc_info()
+        logger.exception(e)
+        return None, e
+
+def render_dataset(task):
+    """Compose the image of a dataset for the extraction area and save it
+    in the output directory, return the (index, file name) of the result or
+    None if the dataset has no data in the area.
+
+    PNG images are returned as (index, file name, PNG data, .aux.xml data)
+    when there is no output directory."""
+    index, dataset, params = task
+    image, image_x, image_y, image_mode, image_palette = get_dataset_data( dataset
+                                                          , TILE_SIZE
+                                                          , params['min_resolution']
+                                                          , params['x1'], params['y1']
+                                                          , params['x2'], params['y2']
+                                                          , params['decode_threads'])
+    if image is None:
+        return None
+    image_width = params['image_width']
+    image_height = params['image_height']
+    if (image_width, image_height, 0, 0) == image.size + (image_x, image_y):
+        # Already composed at the size of the output
+        final_image = image
+    else:
+        final_image = PIL.Image.new(image_mode, (image_width, image_height))
+        final_image.paste(image, (image_x, image_y))
+
+    output_dir = params['output_dir']
+    if 'PNG' == params['output_format']:
+        if image_mode in ['P', 'L'] and image_palette is not None:
+            final_image.putpalette(image_palette.palette)
+        final_image_name = '{}-{}.png'.format( dataset['product_id']
+                                             , dataset['dataset_id'])
+        if output_dir is None:
+            # Return the encoded image and its georeferencing instead
+            image_buffer = StringIO.StringIO()
+            final_image.save(image_buffer, 'PNG')
+            aux_xml = syntool_metadata.georef.get_aux_xml( params['x1'], params['y1']
+                                                         , params['x2'], params['y2']
+                                                         , image_width, image_height)
+            return index, final_image_name, image_buffer.getvalue(), aux_xml
+        final_image_path = os.path.join(output_dir, final_image_name)
+        final_image.save(final_image_path)
+        syntool_metadata.georef.write_aux_xml( final_image_path
+                                             , params['x1'], params['y1']
+                                             , params['x2'], params['y2']
+                                             , image_width, image_height)
+        return index, final_image_name
+    elif 'NUMPY' == params['output_format']:
+        array_data = numpy.array(final_image)
+        array_name = '{}-{}.npy'.format( dataset['product_id']
+                                       , dataset['dataset_id'])
+        array_path = os.path.join(output_dir, array_name)
+        numpy.save(array_path, array_data)
+        return index, array_name
+
+def prepare( root_dir, datasets_list, x1, y1, x2, y2, min_resolution
+           , db_storage, workers=DEFAULT_WORKERS, max_memory=None
+           , tolerance=1.0):
+    """Retrieve the information of the datasets and compute the area and
+    the size of the output images.
+
+    Return the list of datasets and the extraction parameters expected by
+    render_dataset (apart from output_dir, output_format and
+    decode_threads). max_memory only bounds the images being composed, the
+    tile and image caches of the extraction processes come on top of it."""
     IMAGE_MAX_SIZE = 8192
 
-    if not server_host.endswith('/'):
-        server_host = server_host + '/'
-
     if x2 < x1:
         x1, x2 = x2, x1
 
@@ -297,7 +457,13 @@ def get(root_dir, datasets_list, x1, y1, x2, y2, min_resolution, output_format,
     # Retrieve dataset info
     # -------------------------------------------------------------------------
     datasets = []
+    # Datasets requested twice would be written to the same file
+    unique_datasets = []
     for dataset in datasets_list:
+        if dataset not in unique_datasets:
+            unique_datasets.append(dataset)
+
+    for dataset in unique_datasets:
         product_id, dataset_id, dataset_type = dataset.split("+")
         try:
             dataset_info, min_resolution = get_dataset_info( root_dir
@@ -305,7 +471,8 @@ def get(root_dir, datasets_list, x1, y1, x2, y2, min_resolution, output_format,
                                                            , product_id
                                                            , dataset_id
                                                            , dataset_type
-                                                           , db_storage)
+                                                           , db_storage
+                                                           , tolerance)
         except ProductNotAvailableException:
             _, e, _ = sys.exc_info()
             logger.debug(e)
@@ -336,6 +503,88 @@ def get(root_dir, datasets_list, x1, y1, x2, y2, min_resolution, output_format,
     x2 = x1 + dx
     y2 = y1 + dy
 
+    # Each dataset being composed holds an output-sized image
+    if max_memory is not None and 0 < len(datasets):
+        concurrent = max(1, min(workers, len(datasets)))
+        required_memory = image_width * image_height * MAX_PIXEL_SIZE * concurrent
+        if max_memory < required_memory:
+            raise ExtractionTooLargeException(required_memory)
+
+    params = { 'min_resolution': min_resolution
+             , 'x1': x1
+             , 'y1': y1
+             , 'x2': x2
+             , 'y2': y2
+             , 'image_width': image_width
+             , 'image_height': image_height
+             }
+    return datasets, params
+
+def iter_rendered(datasets, params, workers=DEFAULT_WORKERS):
+    """Generate the results of render_dataset for each dataset.
+
+    When workers is greater than 1, datasets are rendered by the shared
+    pool of processes and their results are generated as soon as they are
+    ready, in no particular order."""
+    tasks = [(index, dataset, params) for index, dataset in enumerate(datasets)]
+
+    if 1 >= workers or 1 >= len(tasks):
+        for task in tasks:
+            yield render_dataset(task)
+        return
+
+    # Concurrent extractions queue their datasets on the same pool so that
+    # the number of processes does not grow with the number of requests.
+    # Only workers datasets are submitted at a time: when the generator is
+    # closed (client gone), the remaining ones are never rendered.
+    extraction_pool = get_pool(workers)
+    results = Queue.Queue()
+    pending = iter(tasks)
+    submitted = 0
+    for task in itertools.islice(pending, workers):
+        extraction_pool.apply_async(run_task, (task,), callback=results.put)
+        submitted += 1
+
+    while 0 < submitted:
+        result, e = results.get()
+        submitted -= 1
+        if e is not None:
+            raise e
+        for task in itertools.islice(pending, 1):
+            extraction_pool.apply_async(run_task, (task,), callback=results.put)
+            submitted += 1
+        yield result
+
+def get_pool(workers):
+    """Return the pool of extraction processes, created with workers
+    processes on first use."""
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = multiprocessing.Pool( workers, init_worker
+                                       , (worker_tile_cache_bytes
+                                         , worker_image_cache_bytes))
+    return pool
+
+def get( root_dir, datasets_list, x1, y1, x2, y2, min_resolution, output_format
+       , server_host, download_dir, db_storage, workers=DEFAULT_WORKERS
+       , decode_threads=DEFAULT_DECODE_THREADS, max_memory=None
+       , tolerance=1.0):
+    """Extract the area from the datasets.
+
+    When workers is greater than 1, datasets are composed and encoded by a
+    pool of processes and their results are collected as soon as they are
+    ready. Tiles of each dataset are decoded by decode_threads threads.
+    ExtractionTooLargeException is raised if composing the images would
+    need more than max_memory bytes. See TileMap.select_zoom_level for
+    tolerance."""
+    if not server_host.endswith('/'):
+        server_host = server_host + '/'
+
+    datasets, params = prepare( root_dir, datasets_list, x1, y1, x2, y2
+                              , min_resolution, db_storage, workers
+                              , max_memory, tolerance)
+
     # Prepare output directory
     # -------------------------------------------------------------------------
     if not os.path.exists(download_dir):
@@ -350,35 +599,18 @@ def get(root_dir, datasets_list, x1, y1, x2, y2, min_resolution, output_format,
 
     # Extract data
     # -------------------------------------------------------------------------
+    params['output_dir'] = output_dir
+    params['output_format'] = output_format
+    params['decode_threads'] = decode_threads
+    rendered = iter_rendered(datasets, params, workers)
+
     if 'PNG' == output_format:
         tar = tarfile.open(output_dir + ".tgz", "w:gz")
-        for dataset in datasets:
-            image, image_x, image_y, image_mode, image_palette = get_dataset_data( dataset
-                                                                  , TILE_SIZE
-                                                                  , min_resolution
-                                                                  , x1, y1, x2, y2)
-            if image is None:
+        for result in rendered:
+            if result is None:
                 continue
-            final_image = PIL.Image.new(image_mode, (image_width, image_height))
-            final_image.paste(image, (image_x, image_y))
-            if image_mode in ['P', 'L'] and image_palette is not None:
-                final_image.putpalette(image_palette.palette)
-            final_image_name = '{}-{}.png'.format( dataset['product_id']
-                                                 , dataset['dataset_id'])
+            _, final_image_name = result
             final_image_path = os.path.join(output_dir, final_image_name)
-            final_image.save(final_image_path)
-
-            new_image_path = os.path.splitext(final_image_path)[0] + ".new.png"
-            cmd = "gdal_translate -q -of PNG -a_srs %(proj)s -a_ullr %(west)f %(north)f %(east)f %(south)f \
-                -gcp 0 0 %(west)f %(south)f \
-                -gcp %(width)d 0 %(east)f %(south)f \
-                -gcp 0 %(height)d %(west)f %(north)f \
-                -gcp %(width)d %(height)d %(east)f %(north)f \
-                '%(pngFile)s' '%(newPngFile)s'" % {"proj": "EPSG:3857", "west": x1, "east": x2, "north": y2, "south": y1, "width": image_width, "height": image_height, "pngFile": final_image_path, "newPngFile": new_image_path}
-            subprocess.check_call(cmd, shell=True)
-            os.rename(new_image_path, final_image_path)
-            os.rename(new_image_path + ".aux.xml", final_image_path + ".aux.xml")
-
             tar.add(final_image_path, arcname=final_image_name)
             tar.add(final_image_path + ".aux.xml", arcname=final_image_name + ".aux.xml")
             os.unlink(final_image_path)
@@ -387,24 +619,107 @@ def get(root_dir, datasets_list, x1, y1, x2, y2, min_resolution, output_format,
         tar.close()
         return '{}.tgz'.format(output_dir)
     elif 'NUMPY' == output_format:
-        results = []
-        for dataset in datasets:
-            image, image_x, image_y, image_mode, image_palette = get_dataset_data( dataset
-                                                                  , TILE_SIZE
-                                                                  , min_resolution
-								  , x1, y1, x2, y2)
-            if image is None:
+        regex_str = download_dir + "/" + "(.+)"
+        regex = re.compile(regex_str)
+        rnd_str = regex.findall(output_dir)[0]
+        # Keep the order of the requested datasets
+        array_names = sorted(filter(lambda x: x is not None, rendered))
+        return ['{}download/{}/{}'.format(server_host, rnd_str, array_name)
+                for _, array_name in array_names]
+
+class StreamBuffer(object):
+    """Write-only file object which keeps the data written to it until it is
+    collected with pop. The position is tracked for zipfile."""
+
+    def __init__(self):
+        """ """
+        self.__chunks = []
+        self.__position = 0
+
+    def write(self, data):
+        """ """
+        if 0 < len(data):
+            self.__chunks.append(data)
+            self.__position += len(data)
+
+    def tell(self):
+        """ """
+        return self.__position
+
+    def flush(self):
+        """ """
+        pass
+
+    def pop(self):
+        """ """
+        data = ''.join(self.__chunks)
+        self.__chunks = []
+        return data
+
+def iter_archive(rendered, archive_format):
+    """Generate the content of an archive containing the rendered PNG
+    images and their georeferencing, each image being sent as soon as it is
+    ready.
+
+    If rendering fails, the archive ends with an ERROR_ENTRY_NAME entry and
+    the exception is raised again."""
+    buf = StreamBuffer()
+    if 'zip' == archive_format:
+        # PNG are already compressed
+        archive = zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED, True)
+    else:
+        archive = tarfile.open(fileobj=buf, mode=ARCHIVE_FORMATS[archive_format])
+
+    def add(name, data):
+        if 'zip' == archive_format:
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            info.external_attr = 0o644 << 16
+            archive.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            info.mode = 0o644
+            archive.addfile(info, StringIO.StringIO(data))
+
+    try:
+        for result in rendered:
+            if result is None:
                 continue
-            final_image = PIL.Image.new(image_mode, (image_width, image_height))
-            final_image.paste(image, (image_x, image_y))
-            array_data = numpy.array(final_image)
-            array_name = '{}-{}.npy'.format( dataset['product_id']
-                                           , dataset['dataset_id'])
-            array_path = os.path.join(output_dir, array_name)
-            numpy.save(array_path, array_data)
-
-            regex_str = download_dir + "/" + "(.+)"
-            regex = re.compile(regex_str)
-            rnd_str = regex.findall(output_dir)[0]
-            results.append('{}download/{}/{}'.format(server_host, rnd_str, array_name))
-	return results
+            _, image_name, image_data, aux_xml = result
+            add(image_name, image_data)
+            add('{}.aux.xml'.format(image_name), aux_xml)
+            data = buf.pop()
+            if 0 < len(data):
+                yield data
+    except Exception:
+        # The response has already started: end the archive with an entry
+        # describing the failure, then let the server abort the connection
+        exc_type, e, exc_traceback = sys.exc_info()
+        logger.exception('Extraction failed while streaming the archive')
+        add(ERROR_ENTRY_NAME, 'Extraction failed: {}\n'.format(e))
+        archive.close()
+        yield buf.pop()
+        raise exc_type, e, exc_traceback
+    archive.close()
+    yield buf.pop()
+
+def stream( root_dir, datasets_list, x1, y1, x2, y2, min_resolution
+          , db_storage, archive_format='tgz', workers=DEFAULT_WORKERS
+          , decode_threads=DEFAULT_DECODE_THREADS, max_memory=None
+          , tolerance=1.0):
+    """Extract the area from the datasets as a PNG archive generated on the
+    fly, nothing is written to disk.
+
+    The datasets are retrieved immediately (db_storage is not used by the
+    returned generator). archive_format is one of ARCHIVE_FORMATS, see get
+    for the other parameters."""
+    datasets, params = prepare( root_dir, datasets_list, x1, y1, x2, y2
+                              , min_resolution, db_storage, workers
+                              , max_memory, tolerance)
+    params['output_dir'] = None
+    params['output_format'] = 'PNG'
+    params['decode_threads'] = decode_threads
+    rendered = iter_rendered(datasets, params, workers)
+    return iter_archive(rendered, archive_format)
@@ -0,0 +1,117 @@
+# -*- encoding: utf-8 -*-
+
+"""
+@author: <sylvain.herledan@oceandatalab.com>
+"""
+
+"""
+Copyright (C) 2014-2018 OceanDataLab
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import logging
+import tempfile
+import ConfigParser
+import syntool_metadata.cache
+
+logger = logging.getLogger(__name__)
+
+FEATURES_DIR = 'features'
+SIDECAR_NAME = 'features.json'
+DEFAULT_CACHE_SIZE = 10000
+
+# Parsed sidecars, indexed by their path. Entries are validated against the
+# mtime of the sidecar.
+cache = syntool_metadata.cache.LRUCache(DEFAULT_CACHE_SIZE)
+
+
+def read_features_dir(features_dir):
+    """Parse the .ini files which describe the features of a dataset."""
+    features = []
+    for root, dirs, files in os.walk(features_dir):
+        for ini_path in [os.path.join(root, fn) for fn in files if fn.lower().endswith('.ini')]:
+            ini_parser = ConfigParser.ConfigParser()
+            ini_parser.read(ini_path)
+            feature = dict(ini_parser._sections)
+            for k in feature:
+                feature[k].pop('__name__', None)
+            if 'POLYGON' == feature['global'].get('display_type', None):
+                feature['polygon'] = feature['polygon_EPSG3857'].values()
+            features.append(feature)
+    return features
+
+
+def write_sidecar(dataset_dir):
+    """Parse the features of a dataset and save them in a JSON file in the
+    dataset directory, so that they do not have to be parsed again for each
+    request."""
+    features_dir = os.path.join(dataset_dir, FEATURES_DIR)
+    features = []
+    if os.path.isdir(features_dir):
+        features = read_features_dir(features_dir)
+
+    sidecar_path = os.path.join(dataset_dir, SIDECAR_NAME)
+    fd, tmp_path = tempfile.mkstemp(dir=dataset_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(features, f)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, sidecar_path)
+    except:
+        os.remove(tmp_path)
+        raise
+    return features
+
+
+def get_cached(path, mtime, loader):
+    """ """
+    cached = cache.get(path, None)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    value = loader(path)
+    cache.put(path, (mtime, value))
+    return value
+
+
+def load_sidecar(sidecar_path):
+    """ """
+    with open(sidecar_path, 'r') as f:
+        return json.load(f)
+
+
+def get_features(dataset_dir):
+    """Return the features of a dataset, read from its JSON sidecar or, for
+    datasets ingested by previous versions, from its features directory.
+
+    Features directories are not cached: editing an .ini file does not
+    change the mtime of its directory. Run syntool-rebuild --features to
+    write the sidecars of these datasets."""
+    sidecar_path = os.path.join(dataset_dir, SIDECAR_NAME)
+    try:
+        mtime = os.stat(sidecar_path).st_mtime
+    except OSError:
+        pass
+    else:
+        return get_cached(sidecar_path, mtime, load_sidecar)
+
+    features_dir = os.path.join(dataset_dir, FEATURES_DIR)
+    if not os.path.isdir(features_dir):
+        return []
+    return read_features_dir(features_dir)
@@ -0,0 +1,88 @@
+# -*- encoding: utf-8 -*-
+
+"""
+@author: <sylvain.herledan@oceandatalab.com>
+"""
+
+"""
+Copyright (C) 2014-2018 OceanDataLab
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+import xml.etree.ElementTree
+
+logger = logging.getLogger(__name__)
+
+# Well Known Text of EPSG:3857 as exported by GDAL
+EPSG_3857_WKT = ( 'PROJCS["WGS 84 / Pseudo-Mercator",'
+                  'GEOGCS["WGS 84",'
+                  'DATUM["WGS_1984",'
+                  'SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],'
+                  'AUTHORITY["EPSG","6326"]],'
+                  'PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],'
+                  'UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],'
+                  'AUTHORITY["EPSG","4326"]],'
+                  'PROJECTION["Mercator_1SP"],'
+                  'PARAMETER["central_meridian",0],'
+                  'PARAMETER["scale_factor",1],'
+                  'PARAMETER["false_easting",0],'
+                  'PARAMETER["false_northing",0],'
+                  'UNIT["metre",1,AUTHORITY["EPSG","9001"]],'
+                  'AXIS["X",EAST],'
+                  'AXIS["Y",NORTH],'
+                  'EXTENSION["PROJ4","+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +wktext +no_defs"],'
+                  'AUTHORITY["EPSG","3857"]]')
+
+
+def get_aux_xml(west, south, east, north, width, height, wkt=EPSG_3857_WKT):
+    """Build the GDAL PAM (.aux.xml) document which georeferences a
+    width x height image covering the (west, south, east, north) extent.
+
+    The document contains the same projection, geotransform and ground
+    control points as the one produced by gdal_translate with the -a_srs,
+    -a_ullr and -gcp options."""
+    root = xml.etree.ElementTree.Element('PAMDataset')
+    srs = xml.etree.ElementTree.SubElement(root, 'SRS')
+    srs.text = wkt
+
+    geotransform = [ west, (east - west) / float(width), 0.0
+                   , north, 0.0, (south - north) / float(height)]
+    node = xml.etree.ElementTree.SubElement(root, 'GeoTransform')
+    node.text = ','.join(['{:24.16e}'.format(x) for x in geotransform])
+
+    gcps = [ (0, 0, west, south)
+           , (width, 0, east, south)
+           , (0, height, west, north)
+           , (width, height, east, north)
+           ]
+    gcp_list = xml.etree.ElementTree.SubElement(root, 'GCPList',
+                                                Projection=wkt)
+    for pixel, line, x, y in gcps:
+        xml.etree.ElementTree.SubElement( gcp_list, 'GCP'
+                                        , Id=''
+                                        , Pixel='{:.4f}'.format(pixel)
+                                        , Line='{:.4f}'.format(line)
+                                        , X='{:.12E}'.format(x)
+                                        , Y='{:.12E}'.format(y))
+    return xml.etree.ElementTree.tostring(root)
+
+
+def write_aux_xml(image_path, west, south, east, north, width, height):
+    """Write the .aux.xml file which georeferences image_path."""
+    aux_path = '{}.aux.xml'.format(image_path)
+    with open(aux_path, 'w') as f:
+        f.write(get_aux_xml(west, south, east, north, width, height))
+    return aux_path
@@ -23,59 +23,93 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
 import sys
-import math
-try:
-    import simplejson as json
-except ImportError:
-    import json
 import numpy
+import multiprocessing.pool
+import threading
 import logging
-import PIL.Image
-from xml.etree import ElementTree
+import syntool_metadata.tiles
+import syntool_metadata.tilemap
 
 logger = logging.getLogger(__name__)
 
+# Number of intervals along the transect
+DEFAULT_SAMPLES = 256
+MAX_SAMPLES = 8192
+# Maximum number of datasets sampled by a batch request
+MAX_BATCH_DATASETS = 64
+DEFAULT_WORKERS = 4
+
+# Pool of threads shared by all the batch requests of this process, created
+# on first use (i.e. after the WSGI server has forked its workers)
+pool = None
+pool_lock = threading.Lock()
+
 def get_position_from_zxy(origin, x, y):
     """ """
     sx = x - origin[0]
     sy = origin[1] - y
     return (sx, sy)
 
-def get_histogram_value( sx, sy, dataset_dir, tiles, resolutions, zoom_level
-                       , tile_size):
-    """ """
-    logger.debug('get value {} {} {} {}'.format(sx, sy, zoom_level, tile_size))
-    if 0 > sx or 0 > sy:
-        return 0
-
-    tx = sx / resolutions[zoom_level] / tile_size
-    ty = sy / resolutions[zoom_level] / tile_size
-
-    fracX, intX = math.modf(tx)
-    fracY, intY = math.modf(ty)
-    tile = os.path.join( dataset_dir, 'tiles.zxy', '{}'.format(zoom_level)
-                       , '{}'.format(int(intX)), '{}.png'.format(int(intY)))
-    logger.debug(tile)
-    if not tile in tiles:
-        try:
-            im = PIL.Image.open(tile, "r")
-            pix = im.load()
-        except:
-            pix = None
-        tiles[tile] = pix
-    else:
+def read_tile(tile):
+    """Decode a tile into an array of values (first band of multi-band
+    images), return None if the tile cannot be read."""
+    im = syntool_metadata.tiles.get_tile(tile)
+    if im is None:
+        return None
+    values = numpy.asarray(im)
+    if 3 == values.ndim:
+        values = values[:, :, 0]
+    return values
+
+def get_histogram_values( sx, sy, dataset_dir, tiles, resolutions, zoom_level
+                        , tile_size):
+    """Return the values of the pixels at positions (sx, sy) relative to the
+    world origin, 0 for positions outside of the available tiles.
+
+    Positions are grouped by tile so that each tile is decoded only once."""
+    values = numpy.zeros(sx.shape, dtype=numpy.float64)
+    valid = (0 <= sx) & (0 <= sy)
+    if not numpy.any(valid):
+        return values
+
+    tx = sx[valid] / resolutions[zoom_level] / tile_size
+    ty = sy[valid] / resolutions[zoom_level] / tile_size
+    intX = numpy.floor(tx)
+    intY = numpy.floor(ty)
+    px = ((tx - intX) * tile_size).astype(numpy.int64)
+    py = ((ty - intY) * tile_size).astype(numpy.int64)
+    intX = intX.astype(numpy.int64)
+    intY = intY.astype(numpy.int64)
+
+    manifest = syntool_metadata.tiles.get_manifest(os.path.join(dataset_dir,
+                                                                'tiles.zxy'))
+    valid_values = numpy.zeros(tx.shape, dtype=numpy.float64)
+    tile_keys = numpy.stack((intX, intY), axis=1)
+    unique_keys, tile_indices = numpy.unique(tile_keys, axis=0,
+                                             return_inverse=True)
+    for tile_index, (tile_x, tile_y) in enumerate(unique_keys):
+        if not syntool_metadata.tiles.has_tile(manifest, zoom_level,
+                                               int(tile_x), int(tile_y)):
+            continue
+        tile = os.path.join( dataset_dir, 'tiles.zxy', '{}'.format(zoom_level)
+                           , '{}'.format(tile_x), '{}.png'.format(tile_y))
+        if tile not in tiles:
+            logger.debug(tile)
+            tiles[tile] = read_tile(tile)
         pix = tiles[tile]
+        if pix is None:
+            continue
 
-    if not pix is None:
-        px = int(fracX * tile_size)
-        py = int(fracY * tile_size)
+        in_tile = (tile_indices == tile_index)
+        tile_px = px[in_tile]
+        tile_py = py[in_tile]
+        in_bounds = (tile_px < pix.shape[1]) & (tile_py < pix.shape[0])
+        tile_values = numpy.zeros(tile_px.shape, dtype=numpy.float64)
+        tile_values[in_bounds] = pix[tile_py[in_bounds], tile_px[in_bounds]]
+        valid_values[in_tile] = tile_values
 
-        try:
-            return pix[px, py][0]
-        except:
-            return pix[px, py]
-    else:
-        return 0
+    values[valid] = valid_values
+    return values
 
 
 def init(root_dir, product_id, dataset_id, dataset_type):
@@ -85,88 +119,80 @@ def init(root_dir, product_id, dataset_id, dataset_type):
     if 'ZXY' != dataset_type:
         return (None, None, None)
 
-    tile_dir = os.path.join( root_dir, 'ingested', product_id, dataset_id
-                           , 'tiles.zxy')
-    metadata_file = os.path.join(root_dir, 'ingested', product_id, dataset_id, 'metadata.json')
-    json_tile_file = os.path.join(tile_dir, 'tilemap.json')
-    xml_tile_file = os.path.join(tile_dir, 'tilemap.xml')
-
-    logging.debug(json_tile_file)
-    logging.debug(xml_tile_file)
-    if os.path.exists(metadata_file):
-        with open(metadata_file, 'r') as json_file:
-            json_data = json.load(json_file)
-	    point0, _, point2, _, _ = json_data['bbox_str'][9:-2].split(',')
-            resolutions = { int(x[0]):float(x[1]) for x in map(lambda y: y.split(':'), json_data['resolutions'])}
-            epsg = json_data['syntool_id'].split('_', 1)[0]
-
-	if epsg in ['900913', '3857']:
-            world_origin = numpy.array([-20037508.34, 20037508.34])
-        elif '3413' == epsg:
-            world_origin = numpy.array([-5000000, 11384000])
-        else:
-            raise Exception('Unsupported epsg: {}'.format(epsg))
-
-	"""
-        west, north = map(float, point0.split(' '))
-        east, south = map(float, point2.split(' '))
-        width = east - west
-        height = north - south
-        origin = numpy.array([west, south])
-	"""
-    elif os.path.exists(json_tile_file):
-        with open(json_tile_file) as json_file:
-            json_data = json.load(json_file)
-            world_origin = numpy.array(json_data["tiles"]["origin"])
-
-            bbox = json_data["bbox"]
-            min_x, min_y, max_x, max_y = json_data['bbox']
-            origin = numpy.array([min_x, min_y])
-            width = max_x - min_x
-            height = max_y - min_y
-
-            resolutions = {}
-            for zoom_level in sorted(json_data["tilesets"], key=lambda x: int(x)):
-                resolution = json_data['tilesets'][zoom_level]["units_per_pixel"]
-                zoom_level = int(zoom_level)
-                resolutions[zoom_level] = resolution
-    elif os.path.exists(xml_tile_file):
-        tree = ElementTree.parse(xml_tile_file)
-        root = tree.getroot()
-        origin_node = root.findall(".//Origin")[0]
-        world_origin_x = float(origin_node.attrib['x'])
-        world_origin_y = float(origin_node.attrib['y'])
-        world_origin = numpy.array([world_origin_x, world_origin_y])
-        bbox_node = root.findall(".//BoundingBox")[0]
-        min_x = float(bbox_node.attrib['minx'])
-        max_x = float(bbox_node.attrib['maxx'])
-        min_y = float(bbox_node.attrib['miny'])
-        max_y = float(bbox_node.attrib['maxy'])
-        origin = numpy.array([min_x, min_y])
-        width = max_x - min_x
-        height = max_y - min_y
-
-        resolutions = {}
-        tile_set_nodes = root.findall(".//TileSet")
-        for tile_set_node in tile_set_nodes:
-            resolution = float(tile_set_node.attrib["units-per-pixel"])
-            zoom_level = int(tile_set_node.attrib["order"])
-            resolutions[zoom_level] = resolution
-
+    tilemap = syntool_metadata.tilemap.get_tilemap(root_dir, product_id,
+                                                   dataset_id)
+    world_origin = numpy.array(tilemap.world_origin)
+    resolutions = dict(tilemap.resolutions)
     return tiles, world_origin, resolutions
 
-def get( root_dir, product_id, dataset_id, dataset_type, x1, y1, x2, y2
-       , zoom_level):
+def get_polyline_positions(points, samples):
+    """Return the coordinates of samples + 1 regularly spaced positions on
+    each segment of the polyline, vertices shared by consecutive segments
+    are only included once."""
+    points = numpy.asarray(points, dtype=numpy.float64)
+    i = numpy.arange(samples + 1)
+    p1 = points[:-1]
+    delta = points[1:] - points[:-1]
+    x = p1[:, 0:1] + delta[:, 0:1] / samples * i
+    y = p1[:, 1:2] + delta[:, 1:2] / samples * i
+    x = numpy.concatenate((x[0], x[1:, 1:].ravel()))
+    y = numpy.concatenate((y[0], y[1:, 1:].ravel()))
+    return x, y
+
+def get_image_values(x, y, image_path, bounds):
+    """Return the values of the pixels of an IMAGE dataset at positions
+    (x, y), 0 for positions outside of the image.
+
+    bounds is the (west, north, east, south) extent of the image, as
+    returned by Storage.get_image_info."""
+    values = numpy.zeros(x.shape, dtype=numpy.float64)
+    im = syntool_metadata.tiles.get_image(image_path)
+    if im is None:
+        return values
+
+    west, north, east, south = bounds
+    width, height = im.size
+    resolution = (east - west) / width
+    px = numpy.floor((x - west) / resolution)
+    py = numpy.floor((north - y) / resolution)
+    valid = (0 <= px) & (px < width) & (0 <= py) & (py < height)
+
+    # Only read the sampled pixels, the image can be much larger than the
+    # number of samples
+    pix = im.load()
+    indices = numpy.flatnonzero(valid)
+    for i, col, row in zip(indices, px[valid].astype(int), py[valid].astype(int)):
+        value = pix[col, row]
+        if isinstance(value, tuple):
+            # First band of multi-band images
+            value = value[0]
+        values[i] = value
+    return values
+
+def to_list(values):
     """ """
-    TILE_SIZE = 256
-    STEP = 256
-    p1 = numpy.array([x1, y1])
-    p2 = numpy.array([x2, y2])
+    if numpy.all(numpy.isfinite(values)) \
+    and numpy.all(values == numpy.floor(values)):
+        # Integer tiles
+        values = values.astype(numpy.int64)
+    return values.tolist()
 
-    dx = (p2[0] - p1[0])
-    dy = (p2[1] - p1[1])
+def get_polyline( root_dir, product_id, dataset_id, dataset_type, points
+                , zoom_level, samples=DEFAULT_SAMPLES, image_bounds=None):
+    """Sample the values of a dataset along a polyline, given as a sequence
+    of (x, y) vertices.
 
+    IMAGE datasets are sampled at the resolution of their image, which
+    requires their image_bounds (see get_image_values)."""
+    TILE_SIZE = 256
     dataset_dir = os.path.join(root_dir, 'ingested', product_id, dataset_id)
+    if 'IMAGE' == dataset_type:
+        if image_bounds is None:
+            return []
+        x, y = get_polyline_positions(points, samples)
+        image_path = os.path.join(dataset_dir, 'imageLayer.png')
+        return to_list(get_image_values(x, y, image_path, image_bounds))
+
     tiles, world_origin, resolutions = init( root_dir, product_id, dataset_id
                                            , dataset_type)
     param_missing = ((tiles is None) or (world_origin is None) or
@@ -174,18 +200,85 @@ def get( root_dir, product_id, dataset_id, dataset_type, x1, y1, x2, y2
     if param_missing:
         return []
 
-    logging.debug('{} {} {} {} {}'.format(x1, y1, x2, y2, zoom_level))
+    logging.debug('{} {}'.format(points, zoom_level))
     logging.debug(world_origin)
     logging.debug(resolutions)
-    values = []
-    for i in range(STEP + 1):
-        x = p1[0] + dx / STEP * i
-        y = p1[1] + dy / STEP * i
+    x, y = get_polyline_positions(points, samples)
 
-        sx, sy = get_position_from_zxy(world_origin, x, y)
+    sx, sy = get_position_from_zxy(world_origin, x, y)
 
-        value = get_histogram_value( sx, sy, dataset_dir, tiles, resolutions
-                                   , zoom_level, TILE_SIZE)
-        values.append(value)
+    values = get_histogram_values( sx, sy, dataset_dir, tiles, resolutions
+                                 , zoom_level, TILE_SIZE)
+    return to_list(values)
 
-    return values
+def get_image_bounds(db_storage, product_id, dataset_id, dataset_type):
+    """ """
+    if 'IMAGE' != dataset_type or db_storage is None:
+        return None
+    return db_storage.get_image_info(product_id, dataset_id)
+
+def get( root_dir, product_id, dataset_id, dataset_type, x1, y1, x2, y2
+       , zoom_level, samples=DEFAULT_SAMPLES, db_storage=None):
+    """Sample samples + 1 values along the segment between (x1, y1) and
+    (x2, y2). db_storage provides the extent of IMAGE datasets."""
+    image_bounds = get_image_bounds(db_storage, product_id, dataset_id,
+                                    dataset_type)
+    return get_polyline( root_dir, product_id, dataset_id, dataset_type
+                       , [(x1, y1), (x2, y2)], zoom_level, samples
+                       , image_bounds)
+
+def get_batch( root_dir, datasets, points, zoom_level, samples=DEFAULT_SAMPLES
+             , workers=DEFAULT_WORKERS, db_storage=None):
+    """Sample several datasets along the same polyline.
+
+    datasets is a list of (product_id, dataset_id, dataset_type) tuples,
+    they are processed by the pool of workers threads shared by the
+    requests of this process (decoded tiles and tilemaps are shared through
+    the process-wide caches). The profile of a dataset which cannot be read
+    contains an error message instead of values."""
+    # Database queries are made by the calling thread, which owns the session
+    images_bounds = {}
+    for product_id, dataset_id, dataset_type in datasets:
+        try:
+            image_bounds = get_image_bounds(db_storage, product_id,
+                                            dataset_id, dataset_type)
+        except Exception:
+            logger.exception('Could not read the extent of {}/{}'.format(
+                             product_id, dataset_id))
+            image_bounds = None
+        images_bounds[(product_id, dataset_id)] = image_bounds
+
+    def get_profile(dataset):
+        product_id, dataset_id, dataset_type = dataset
+        image_bounds = images_bounds[(product_id, dataset_id)]
+        profile = { 'productId': product_id
+                  , 'datasetId': '{}+{}'.format(dataset_id, dataset_type)
+                  }
+        try:
+            profile['values'] = get_polyline( root_dir, product_id
+                                            , dataset_id, dataset_type
+                                            , points, zoom_level, samples
+                                            , image_bounds)
+        except Exception:
+            _, e, _ = sys.exc_info()
+            logger.exception('Could not sample {}/{}'.format(product_id,
+                                                             dataset_id))
+            profile['values'] = []
+            profile['error'] = str(e)
+        return profile
+
+    if 1 >= workers or 1 >= len(datasets):
+        return map(get_profile, datasets)
+
+    # Concurrent requests queue their datasets on the same pool so that the
+    # number of threads does not grow with the number of requests
+    return get_pool(workers).map(get_profile, datasets)
+
+def get_pool(workers):
+    """Return the pool of sampling threads, created with workers threads on
+    first use."""
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = multiprocessing.pool.ThreadPool(workers)
+    return pool
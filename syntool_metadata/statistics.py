@@ -0,0 +1,166 @@
+# -*- encoding: utf-8 -*-
+
+"""
+@author: <sylvain.herledan@oceandatalab.com>
+"""
+
+"""
+Copyright (C) 2014-2018 OceanDataLab
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import numpy
+import logging
+import syntool_metadata.tiles
+import syntool_metadata.tilemap
+
+logger = logging.getLogger(__name__)
+
+TILE_SIZE = 256
+# Maximum number of tiles read to compute the statistics of an area
+MAX_TILES = 1024
+DEFAULT_BINS = 256
+MAX_BINS = 4096
+DEFAULT_PERCENTILES = [5, 25, 50, 75, 95]
+
+
+class TooManyTilesException(Exception):
+    pass
+
+
+class DatasetTypeNotSupportedException(Exception):
+    pass
+
+
+class DatasetNotAvailableException(Exception):
+    pass
+
+
+def get_tile_values(tile_path):
+    """Return the values (first band) of a tile and the mask of its valid
+    pixels, or (None, None) if the tile does not exist.
+
+    Transparent pixels, either because of an alpha band or of the
+    transparency index of the tile, are not valid."""
+    image = syntool_metadata.tiles.get_tile(tile_path)
+    if image is None:
+        return None, None
+    pixels = numpy.asarray(image)
+    if 3 == pixels.ndim:
+        values = pixels[:, :, 0]
+    else:
+        values = pixels
+
+    if 'A' in image.getbands():
+        valid = (0 < pixels[:, :, -1])
+    elif isinstance(image.info.get('transparency', None), int):
+        valid = (values != image.info['transparency'])
+    else:
+        valid = numpy.ones(values.shape, dtype=numpy.bool_)
+    return values, valid
+
+
+def get_area_values(tilemap, tile_dir, zoom_level, resolution, x1, y1, x2, y2):
+    """Return the valid values of the pixels of a zoom level inside the
+    (x1, y1, x2, y2) area."""
+    world_x, world_y = tilemap.world_origin
+    # Pixel window, with rows counted from the top of the tiling grid
+    px1 = max(0, int(numpy.floor((x1 - world_x) / resolution)))
+    px2 = int(numpy.ceil((x2 - world_x) / resolution))
+    py1 = max(0, int(numpy.floor((world_y - y2) / resolution)))
+    py2 = int(numpy.ceil((world_y - y1) / resolution))
+    if px2 <= px1 or py2 <= py1:
+        return numpy.array([])
+
+    tx_range = range(px1 // TILE_SIZE, (px2 - 1) // TILE_SIZE + 1)
+    ty_range = range(py1 // TILE_SIZE, (py2 - 1) // TILE_SIZE + 1)
+    if MAX_TILES < len(tx_range) * len(ty_range):
+        raise TooManyTilesException()
+
+    manifest = syntool_metadata.tiles.get_manifest(tile_dir)
+    area_values = []
+    for tx in tx_range:
+        for ty in ty_range:
+            if not syntool_metadata.tiles.has_tile(manifest, zoom_level, tx, ty):
+                continue
+            tile_path = os.path.join(tile_dir, '{}'.format(zoom_level),
+                                     '{}'.format(tx), '{}.png'.format(ty))
+            values, valid = get_tile_values(tile_path)
+            if values is None:
+                # Totally transparent tiles are not produced
+                continue
+            col1 = max(0, px1 - tx * TILE_SIZE)
+            col2 = min(values.shape[1], px2 - tx * TILE_SIZE)
+            row1 = max(0, py1 - ty * TILE_SIZE)
+            row2 = min(values.shape[0], py2 - ty * TILE_SIZE)
+            window = (slice(row1, row2), slice(col1, col2))
+            area_values.append(values[window][valid[window]])
+
+    if 0 >= len(area_values):
+        return numpy.array([])
+    return numpy.concatenate(area_values)
+
+
+def get( root_dir, product_id, dataset_id, dataset_type, x1, y1, x2, y2
+       , resolution, bins=DEFAULT_BINS, percentiles=DEFAULT_PERCENTILES):
+    """Compute the statistics of the values of a ZXY dataset inside the
+    (x1, y1, x2, y2) area.
+
+    Values are read from the coarsest zoom level whose resolution (in units
+    per pixel) is at least as fine as the requested one."""
+    if 'ZXY' != dataset_type:
+        msg = '"{}" type not supported'.format(dataset_type)
+        raise DatasetTypeNotSupportedException(msg)
+
+    if x2 < x1:
+        x1, x2 = x2, x1
+    if y2 < y1:
+        y1, y2 = y2, y1
+
+    try:
+        tilemap = syntool_metadata.tilemap.get_tilemap(root_dir, product_id,
+                                                       dataset_id)
+    except Exception:
+        logger.exception('Could not read the tilemap of {}/{}'.format(
+                         product_id, dataset_id))
+        msg = 'Dataset {}/{} not available'.format(product_id, dataset_id)
+        raise DatasetNotAvailableException(msg)
+    zoom_level, zoom_resolution = tilemap.select_zoom_level(resolution)
+    tile_dir = os.path.join(root_dir, 'ingested', product_id, dataset_id,
+                            'tiles.zxy')
+    values = get_area_values(tilemap, tile_dir, zoom_level, zoom_resolution,
+                             x1, y1, x2, y2)
+    values = values.astype(numpy.float64)
+
+    result = { 'zoomLevel': zoom_level
+             , 'resolution': zoom_resolution
+             , 'count': int(values.size)
+             }
+    if 0 >= values.size:
+        return result
+
+    result['min'] = float(values.min())
+    result['max'] = float(values.max())
+    result['mean'] = float(values.mean())
+    result['std'] = float(values.std())
+    percentile_values = numpy.percentile(values, percentiles)
+    result['percentiles'] = dict(zip(['{:g}'.format(p) for p in percentiles],
+                                     percentile_values.tolist()))
+    counts, edges = numpy.histogram(values, bins=bins)
+    result['histogram'] = { 'counts': counts.tolist()
+                          , 'edges': edges.tolist()
+                          }
+    return result
@@ -0,0 +1,177 @@
+# -*- encoding: utf-8 -*-
+
+"""
+@author: <sylvain.herledan@oceandatalab.com>
+"""
+
+"""
+Copyright (C) 2014-2018 OceanDataLab
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import logging
+import collections
+import xml.etree.ElementTree
+import syntool_metadata.cache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 10000
+
+# Origin of the tiling grid for projections which are identified by their
+# EPSG code only (in metadata.json)
+WORLD_ORIGINS = { '900913': (-20037508.34, 20037508.34)
+                , '3857': (-20037508.34, 20037508.34)
+                , '3413': (-5000000, 11384000)
+                }
+
+# Parsed tilemaps, indexed by the path of the file they have been read from.
+# Entries are validated against the mtime of that file.
+cache = syntool_metadata.cache.LRUCache(DEFAULT_CACHE_SIZE)
+
+
+class TileMap(collections.namedtuple('TileMap', [ 'epsg', 'origin'
+                                                , 'world_origin', 'bbox'
+                                                , 'resolutions'])):
+    """Tiling geometry of a ZXY dataset.
+
+    origin and world_origin are (x, y) tuples, bbox is a (min_x, min_y,
+    max_x, max_y) tuple and resolutions a tuple of (zoom_level,
+    units_per_pixel) sorted by zoom level."""
+    __slots__ = ()
+
+    @property
+    def width(self):
+        """ """
+        return self.bbox[2] - self.bbox[0]
+
+    @property
+    def height(self):
+        """ """
+        return self.bbox[3] - self.bbox[1]
+
+    def select_zoom_level(self, resolution, tolerance=1.0):
+        """Return the (zoom_level, units_per_pixel) of the coarsest level
+        whose resolution is at least as fine as the requested one, or of the
+        finest level if none is.
+
+        A tolerance greater than 1 accepts levels up to tolerance times
+        coarser than requested (e.g. 2 for one zoom level), which reads far
+        fewer tiles for previews of large areas."""
+        for level, level_resolution in self.resolutions:
+            if level_resolution <= resolution * tolerance:
+                return level, level_resolution
+        return self.resolutions[-1]
+
+    def get_resolution(self, zoom_level):
+        """ """
+        for level, resolution in self.resolutions:
+            if level == zoom_level:
+                return resolution
+        raise KeyError(zoom_level)
+
+
+def get_world_origin(epsg):
+    """ """
+    if epsg not in WORLD_ORIGINS:
+        raise Exception('Unsupported epsg: {}'.format(epsg))
+    return WORLD_ORIGINS[epsg]
+
+
+def read_metadata(metadata_path, epsg):
+    """Parse the metadata.json file produced by the ingestor."""
+    with open(metadata_path, 'r') as json_file:
+        json_data = json.load(json_file)
+    point0, _, point2, _, _ = json_data['bbox_str'][9:-2].split(',')
+    west, north = map(float, point0.split(' '))
+    east, south = map(float, point2.split(' '))
+    resolutions = [(int(x[0]), float(x[1]))
+                   for x in map(lambda y: y.split(':'), json_data['resolutions'])]
+    epsg = json_data['syntool_id'].split('_', 1)[0]
+    return TileMap( epsg
+                  , (west, south)
+                  , get_world_origin(epsg)
+                  , (west, south, east, north)
+                  , tuple(sorted(resolutions)))
+
+
+def read_tilemap_json(json_tile_path, epsg):
+    """ """
+    with open(json_tile_path, 'r') as json_file:
+        json_data = json.load(json_file)
+    min_x, min_y, max_x, max_y = json_data['bbox']
+    resolutions = [(int(zoom_level), float(tileset['units_per_pixel']))
+                   for zoom_level, tileset in json_data['tilesets'].iteritems()]
+    return TileMap( epsg
+                  , (min_x, min_y)
+                  , tuple(json_data['tiles']['origin'])
+                  , (min_x, min_y, max_x, max_y)
+                  , tuple(sorted(resolutions)))
+
+
+def read_tilemap_xml(xml_tile_path, epsg):
+    """ """
+    tree = xml.etree.ElementTree.parse(xml_tile_path)
+    root = tree.getroot()
+    origin_node = root.findall('.//Origin')[0]
+    world_origin = (float(origin_node.attrib['x']),
+                    float(origin_node.attrib['y']))
+    bbox_node = root.findall('.//BoundingBox')[0]
+    min_x = float(bbox_node.attrib['minx'])
+    max_x = float(bbox_node.attrib['maxx'])
+    min_y = float(bbox_node.attrib['miny'])
+    max_y = float(bbox_node.attrib['maxy'])
+    resolutions = [(int(x.attrib['order']), float(x.attrib['units-per-pixel']))
+                   for x in root.findall('.//TileSet')]
+    return TileMap( epsg
+                  , (min_x, min_y)
+                  , world_origin
+                  , (min_x, min_y, max_x, max_y)
+                  , tuple(sorted(resolutions)))
+
+
+def get_tilemap(root_dir, product_id, dataset_id):
+    """Return the TileMap of a ZXY dataset, read from its metadata.json,
+    tiles.zxy/tilemap.json or tiles.zxy/tilemap.xml file (in this order of
+    preference)."""
+    dataset_dir = os.path.join(root_dir, 'ingested', product_id, dataset_id)
+    tile_dir = os.path.join(dataset_dir, 'tiles.zxy')
+    # Product identifiers start with the EPSG code of their projection
+    epsg = product_id.split('_', 1)[0]
+
+    readers = [ (os.path.join(dataset_dir, 'metadata.json'), read_metadata)
+              , (os.path.join(tile_dir, 'tilemap.json'), read_tilemap_json)
+              , (os.path.join(tile_dir, 'tilemap.xml'), read_tilemap_xml)
+              ]
+    for path, reader in readers:
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            continue
+
+        cached = cache.get(path, None)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        logger.debug('Reading {}'.format(path))
+        tilemap = reader(path, epsg)
+        cache.put(path, (mtime, tilemap))
+        return tilemap
+
+    raise Exception('Tilemap (json or xml) not found in "{}"'.format(tile_dir))
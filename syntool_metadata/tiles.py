@@ -0,0 +1,200 @@
+# -*- encoding: utf-8 -*-
+
+"""
+@author: <sylvain.herledan@oceandatalab.com>
+"""
+
+"""
+Copyright (C) 2014-2018 OceanDataLab
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+try:
+    import simplejson as json
+except ImportError:
+    import json
+import logging
+import tempfile
+import PIL.Image
+import syntool_metadata.cache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+DEFAULT_IMAGE_CACHE_BYTES = 256 * 1024 * 1024
+MANIFEST_NAME = 'manifest.json'
+DEFAULT_MANIFEST_CACHE_SIZE = 1000
+DEFAULT_DIMENSIONS_CACHE_SIZE = 10000
+
+# Bytes used by each pixel of the images decoded by PIL, depending on their
+# mode (other modes use 4 bytes per pixel).
+PIXEL_SIZES = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2, 'I;16B': 2, 'I;16L': 2}
+
+
+def get_image_size(image):
+    """Estimate the memory used by a decoded image."""
+    width, height = image.size
+    return width * height * PIXEL_SIZES.get(image.mode, 4)
+
+
+# Decoded tiles, indexed by (path, mtime) so that tiles which have been
+# replaced on disk are read again. Cached images are shared between threads
+# and must not be modified.
+cache = syntool_metadata.cache.LRUCache(None, DEFAULT_CACHE_BYTES,
+                                        get_image_size)
+
+# Decoded images of IMAGE datasets, kept apart from the tiles so that a
+# large image does not evict them.
+images = syntool_metadata.cache.LRUCache(None, DEFAULT_IMAGE_CACHE_BYTES,
+                                         get_image_size)
+
+
+# Tile manifests, indexed by the path of the manifest file. Entries are
+# validated against the mtime of that file.
+manifests = syntool_metadata.cache.LRUCache(DEFAULT_MANIFEST_CACHE_SIZE)
+
+
+def build_manifest(tile_dir):
+    """List the tiles of a tiles.zxy directory.
+
+    The manifest maps each zoom level to the columns which have tiles and
+    each column to the sorted rows of its tiles (totally transparent tiles
+    are not produced, so most datasets are sparse)."""
+    manifest = {}
+    for zoom_level in os.listdir(tile_dir):
+        zoom_dir = os.path.join(tile_dir, zoom_level)
+        if not zoom_level.isdigit() or not os.path.isdir(zoom_dir):
+            continue
+        columns = {}
+        for x in os.listdir(zoom_dir):
+            column_dir = os.path.join(zoom_dir, x)
+            if not x.isdigit() or not os.path.isdir(column_dir):
+                continue
+            rows = [int(fn[:-4]) for fn in os.listdir(column_dir)
+                    if fn.endswith('.png') and fn[:-4].isdigit()]
+            if 0 < len(rows):
+                columns[x] = sorted(rows)
+        manifest[zoom_level] = columns
+    return manifest
+
+
+def write_manifest(tile_dir):
+    """Save the manifest of a tiles.zxy directory in that directory, so
+    that services can check which tiles exist without probing the
+    filesystem."""
+    manifest = build_manifest(tile_dir)
+    manifest_path = os.path.join(tile_dir, MANIFEST_NAME)
+    fd, tmp_path = tempfile.mkstemp(dir=tile_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f, separators=(',', ':'))
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, manifest_path)
+    except:
+        os.remove(tmp_path)
+        raise
+    return manifest
+
+
+def load_manifest(manifest_path):
+    """Read a manifest as a dict of sets of (x, y) tiles indexed by zoom
+    level."""
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    tiles = {}
+    for zoom_level, columns in manifest.iteritems():
+        tiles[int(zoom_level)] = frozenset([(int(x), y)
+                                            for x, rows in columns.iteritems()
+                                            for y in rows])
+    return tiles
+
+
+def get_manifest(tile_dir):
+    """Return the tiles listed in the manifest of a tiles.zxy directory, as
+    a dict of sets of (x, y) indexed by zoom level, or None if the
+    directory has no manifest (datasets ingested by previous versions)."""
+    manifest_path = os.path.join(tile_dir, MANIFEST_NAME)
+    try:
+        mtime = os.stat(manifest_path).st_mtime
+    except OSError:
+        return None
+
+    cached = manifests.get(manifest_path, None)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    tiles = load_manifest(manifest_path)
+    manifests.put(manifest_path, (mtime, tiles))
+    return tiles
+
+
+def has_tile(manifest, zoom_level, x, y):
+    """Tell if a tile exists according to a manifest. Tiles are assumed to
+    exist if there is no manifest."""
+    if manifest is None:
+        return True
+    return (x, y) in manifest.get(zoom_level, ())
+
+
+# (width, height) of images, indexed by path and validated against the mtime
+# of the image file.
+dimensions = syntool_metadata.cache.LRUCache(DEFAULT_DIMENSIONS_CACHE_SIZE)
+
+
+def get_image_dimensions(image_path):
+    """Return the (width, height) of an image without decoding it, nor even
+    opening it if its size is already known."""
+    mtime = os.stat(image_path).st_mtime
+    cached = dimensions.get(image_path, None)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    image = PIL.Image.open(image_path, 'r')
+    size = image.size
+    dimensions.put(image_path, (mtime, size))
+    return size
+
+
+def get_tile(tile_path):
+    """Return the decoded image of a tile, or None if it does not exist or
+    cannot be decoded."""
+    return get_cached_image(tile_path, cache)
+
+
+def get_image(image_path):
+    """Return the decoded imageLayer.png of an IMAGE dataset, or None if it
+    does not exist or cannot be decoded."""
+    return get_cached_image(image_path, images)
+
+
+def get_cached_image(image_path, image_cache):
+    """ """
+    try:
+        mtime = os.stat(image_path).st_mtime
+    except OSError:
+        return None
+
+    key = (image_path, mtime)
+    image = image_cache.get(key, None)
+    if image is not None:
+        return image
+
+    try:
+        image = PIL.Image.open(image_path, 'r')
+        image.load()
+    except:
+        logger.warning('Could not decode {}'.format(image_path))
+        return None
+    image_cache.put(key, image)
+    return image
@@ -28,14 +28,19 @@ from routr.exc import NoMatchFound
 import syntool_metadata.db
 import syntool_metadata.histogram
 import syntool_metadata.extract
+import syntool_metadata.statistics
+import syntool_metadata.cache
+import syntool_metadata.tiles
 import ConfigParser
 import datetime
+import numpy
 try:
     import simplejson as json
 except ImportError:
     import json
 import sys
 import os
+import zlib
 
 # Load settings
 # ----------------------------------------------------------------------------
@@ -54,32 +59,196 @@ db_uri = 'mysql://{}:{}@{}:{}/{}'.format( db_cfg.get('user', 'syntool')
                                      , db_cfg.get('host', 'localhost')
                                      , db_cfg.get('port', 3306)
                                      , db_cfg.get('name', 'syntool'))
-storage_type = syntool_metadata.db.Storage(db_uri)
+
+def parse_bool(value):
+    """ """
+    if isinstance(value, bool):
+        return value
+    return value.strip().lower() in ['1', 'yes', 'true', 'on']
+
+catalog_ttl = int(db_cfg.get('catalog_ttl',
+                             syntool_metadata.db.DEFAULT_CATALOG_TTL))
+pool_size = int(db_cfg.get('pool_size', syntool_metadata.db.DEFAULT_POOL_SIZE))
+max_overflow = int(db_cfg.get('max_overflow',
+                              syntool_metadata.db.DEFAULT_MAX_OVERFLOW))
+pool_recycle = int(db_cfg.get('pool_recycle',
+                              syntool_metadata.db.DEFAULT_POOL_RECYCLE))
+pool_pre_ping = parse_bool(db_cfg.get('pool_pre_ping', True))
+pool_timeout = int(db_cfg.get('pool_timeout',
+                              syntool_metadata.db.DEFAULT_POOL_TIMEOUT))
+connect_timeout = db_cfg.get('connect_timeout', None)
+if connect_timeout is not None:
+    connect_timeout = int(connect_timeout)
+cache_cfg = ini_parser._sections.get('cache', {})
+generation_ttl = float(cache_cfg.get('generation_ttl',
+                                     syntool_metadata.db.DEFAULT_GENERATION_TTL))
+query_workers = int(db_cfg.get('query_workers',
+                               syntool_metadata.db.DEFAULT_QUERY_WORKERS))
+storage_type = syntool_metadata.db.Storage( db_uri
+                                          , catalog_ttl=catalog_ttl
+                                          , pool_size=pool_size
+                                          , max_overflow=max_overflow
+                                          , pool_recycle=pool_recycle
+                                          , pool_pre_ping=pool_pre_ping
+                                          , pool_timeout=pool_timeout
+                                          , connect_timeout=connect_timeout
+                                          , generation_ttl=generation_ttl
+                                          , query_workers=query_workers)
 
 root_dir = ini_parser._sections['general']['root_dir']
 download_dir = ini_parser._sections['general']['download_dir']
 results_limit = int(ini_parser._sections['database'].get('results_limit',
                                                          5000))
+global_order = parse_bool(db_cfg.get('global_order', False))
+stream_datasets = parse_bool(db_cfg.get('stream_datasets', False))
+histogram_workers = int(ini_parser._sections['general'].get('histogram_workers',
+                                                             syntool_metadata.histogram.DEFAULT_WORKERS))
+extract_workers = int(ini_parser._sections['general'].get('extract_workers',
+                                                           syntool_metadata.extract.DEFAULT_WORKERS))
+decode_threads = int(ini_parser._sections['general'].get('decode_threads',
+                                                          syntool_metadata.extract.DEFAULT_DECODE_THREADS))
+extract_max_memory = ini_parser._sections['general'].get('extract_max_memory', None)
+if extract_max_memory is not None:
+    # Megabytes
+    extract_max_memory = int(extract_max_memory) * 1024 * 1024
+preview_tolerance = float(ini_parser._sections['general'].get('preview_tolerance', 2.0))
+archive_format = ini_parser._sections['general'].get('archive_format', 'tgz')
+compress_search = parse_bool(ini_parser._sections['general'].get('compress_search', True))
+
+response_cache_size = int(cache_cfg.get('max_entries', 1000))
+# Megabytes
+response_cache_bytes = int(cache_cfg.get('max_size', 64)) * 1024 * 1024
+
+tile_cache_size = cache_cfg.get('tiles_max_size', None)
+if tile_cache_size is not None:
+    # Megabytes
+    syntool_metadata.tiles.cache.max_bytes = int(tile_cache_size) * 1024 * 1024
+image_cache_size = cache_cfg.get('images_max_size', None)
+if image_cache_size is not None:
+    # Megabytes
+    syntool_metadata.tiles.images.max_bytes = int(image_cache_size) * 1024 * 1024
+extract_tile_cache_size = cache_cfg.get('extract_tiles_max_size', None)
+if extract_tile_cache_size is not None:
+    # Megabytes
+    syntool_metadata.extract.worker_tile_cache_bytes = int(extract_tile_cache_size) * 1024 * 1024
+extract_image_cache_size = cache_cfg.get('extract_images_max_size', None)
+if extract_image_cache_size is not None:
+    # Megabytes
+    syntool_metadata.extract.worker_image_cache_bytes = int(extract_image_cache_size) * 1024 * 1024
 
 url_prefix = os.environ.get('URL_PREFIX', '')
 tile_servers = os.environ.get('SYNTOOL_TILE_SERVERS', '').split(',')
 tile_servers = filter(lambda x: 0 < len(x), tile_servers)
 
-DAY_IN_SECONDS = 24 * 60 * 60
-
 def parse_client_product_availability(cpa):
+    """Return the days (since 1970-01-01) and granules count sent by the
+    client for a product."""
     if cpa is None or len(cpa) == 0:
-        return []
+        return None
 
-    cpa = json.loads(cpa)
-    client_product_availability = []
-    for i in xrange(0, len(cpa), 2):
-        date_in_days = cpa[i]
-        arity = cpa[i + 1]
-        date = datetime.datetime.utcfromtimestamp(date_in_days * DAY_IN_SECONDS)
-        client_product_availability.append((arity, date))
+    cpa = numpy.array(json.loads(cpa), dtype=numpy.int64)
+    days = cpa[0::2]
+    arities = cpa[1::2]
+    return days, arities
+
+# Response cache
+# ----------------------------------------------------------------------------
+# Parameters which do not change the result of a request
+UNCACHED_PARAMETERS = ['callback', '_']
+
+def get_cached_size(cached):
+    """Size of a cached (generation, JSON document) item."""
+    _, content = cached
+    return len(content)
+
+response_cache = None
+if 0 < response_cache_size:
+    response_cache = syntool_metadata.cache.LRUCache( response_cache_size
+                                                    , response_cache_bytes
+                                                    , get_cached_size)
+
+def get_cached_json(service, kwargs, products, compute):
+    """Return the JSON document of the result of compute() for these request
+    parameters. Documents are cached as long as no dataset has been added to
+    the requested products since they have been computed."""
+    if response_cache is None or products is None:
+        return json.dumps(compute())
+
+    key = [(k, v) for k, v in kwargs.iteritems() if k not in UNCACHED_PARAMETERS]
+    key = (service,) + tuple(sorted(key))
+    generations = storage_type.get_generations()
+    generation = tuple([generations.get(p, 0) for p in products])
+
+    cached = response_cache.get(key, None)
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+
+    # A product which has datasets but no table in the catalog has been
+    # created after the catalog was read: the result would miss it while
+    # being cached under its current generation.
+    existing_tables = storage_type.get_existing_tables()
+    for product_id, product_generation in zip(products, generation):
+        table_name = syntool_metadata.db.Storage.get_product_table_name(product_id)
+        if 0 < product_generation and table_name not in existing_tables:
+            storage_type.refresh_catalog()
+            break
+
+    content = json.dumps(compute())
+    response_cache.put(key, (generation, content))
+    return content
+
+def get_json_response(content, kwargs):
+    """ """
+    if 'callback' in kwargs:
+        return '{}({})'.format(kwargs['callback'], content)
+    r = Response()
+    r.content_type = 'application/json'
+    r.body = content
+    return r
 
-    return client_product_availability
+# Streaming
+# ----------------------------------------------------------------------------
+# Size (in bytes) of the chunks sent to the client by streamed responses
+STREAM_CHUNK_SIZE = 65536
+
+def iter_chunks(parts):
+    """Group small strings into chunks of about STREAM_CHUNK_SIZE bytes."""
+    chunk = []
+    chunk_size = 0
+    for part in parts:
+        chunk.append(part)
+        chunk_size = chunk_size + len(part)
+        if STREAM_CHUNK_SIZE <= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            chunk_size = 0
+    if 0 < len(chunk):
+        yield ''.join(chunk)
+
+def iter_gzip(chunks):
+    """Compress chunks on the fly with the gzip format."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if 0 < len(compressed):
+            yield compressed
+    yield compressor.flush()
+
+def iter_datasets_json(callback, *args, **kwargs):
+    """Generate the JSON (or JSONP) document listing datasets, one dataset
+    at a time. The session stays open until the document is complete."""
+    if callback is not None:
+        yield '{}('.format(callback)
+    yield '{"events": ['
+    with storage_type.get_session() as storage:
+        separator = ''
+        for dataset in storage.iter_datasets(*args, **kwargs):
+            yield separator
+            yield json.dumps(dataset)
+            separator = ', '
+    yield ']}'
+    if callback is not None:
+        yield ')'
 
 # Services
 # ----------------------------------------------------------------------------
@@ -137,24 +306,23 @@ def get_availability(environ, *args, **kwargs):
     else:
         client_availability = None
 
-    with storage_type.get_session() as storage:
-        result = storage.get_availability( year
-                                         , month
-                                         , day
-                                         , extent
-                                         , products_filter
-                                         , patterns
-                                         , client_availability)
-
-    if result is None:
-        result = {'years': {}, 'months': {}, 'days': {},
-                  'error': 'No product available, please check that you did ' \
-                           'not mispell product identifiers in the request'}
-
-    if 'callback' in kwargs:
-      return '{}({})'.format(kwargs['callback'], json.dumps(result))
-    else:
-      return result
+    def compute():
+        with storage_type.get_session() as storage:
+            result = storage.get_availability( year
+                                             , month
+                                             , day
+                                             , extent
+                                             , products_filter
+                                             , patterns
+                                             , client_availability)
+        if result is None:
+            result = {'years': {}, 'months': {}, 'days': {},
+                      'error': 'No product available, please check that you did ' \
+                               'not mispell product identifiers in the request'}
+        return result
+
+    content = get_cached_json('availability', kwargs, products_filter, compute)
+    return get_json_response(content, kwargs)
 
 def get_datasets(environ, *args, **kwargs):
     """ """
@@ -185,22 +353,42 @@ def get_datasets(environ, *args, **kwargs):
     minD = datetime.datetime.utcfromtimestamp(float(kwargs['minDate']))
     maxD = datetime.datetime.utcfromtimestamp(float(kwargs['maxDate']))
 
-    with storage_type.get_session() as storage:
-        datasets = storage.get_datasets( 'data/'
-				       , root_dir
-                                       , minD
-                                       , maxD
-                                       , extent
-                                       , products_filter
-                                       , patterns
-                                       , results_limit)
-
-    result = {'events': datasets}
-
-    if 'callback' in kwargs:
-      return '{}({})'.format(kwargs['callback'], json.dumps(result))
-    else:
-      return result
+    if stream_datasets is True:
+        # Streamed responses are never cached
+        callback = kwargs.get('callback', None)
+        content = iter_datasets_json( callback
+                                    , 'data/'
+                                    , root_dir
+                                    , minD
+                                    , maxD
+                                    , extent
+                                    , products_filter
+                                    , patterns
+                                    , results_limit
+                                    , global_order=global_order)
+        r = Response()
+        r.app_iter = iter_chunks(content)
+        if callback is None:
+            r.content_type = 'application/json'
+        else:
+            r.content_type = 'application/javascript'
+        return r
+
+    def compute():
+        with storage_type.get_session() as storage:
+            datasets = storage.get_datasets( 'data/'
+                                           , root_dir
+                                           , minD
+                                           , maxD
+                                           , extent
+                                           , products_filter
+                                           , patterns
+                                           , results_limit
+                                           , global_order=global_order)
+        return {'events': datasets}
+
+    content = get_cached_json('datasets', kwargs, products_filter, compute)
+    return get_json_response(content, kwargs)
 
 def search_datasets(environ, *args, **kwargs):
     """ """
@@ -240,27 +428,35 @@ def search_datasets(environ, *args, **kwargs):
     minD = datetime.datetime.utcfromtimestamp(float(kwargs['minDate']))
     maxD = datetime.datetime.utcfromtimestamp(float(kwargs['maxDate']))
 
-    with storage_type.get_session() as storage:
-        datasets = storage.search_datasets( minD
-                                          , maxD
-                                          , extent
-                                          , products_filter
-                                          , patterns)
-
-    result = []
     if 'url' == output_format:
         server_host = environ['SERVER_HOST']
         if not server_host.endswith('/'):
             server_host = '{}/'.format(server_host)
-        for product_id, product_items in datasets.iteritems():
-            product_datasets = map(lambda x: '{}data/ingested/{}/{}'.format(server_host, product_id, x), product_items)
-            result.extend(product_datasets)
+        line_format = lambda product_id, x: '{}data/ingested/{}/{}'.format(server_host, product_id, x)
     elif 'path' == output_format:
-        for product_id, product_items in datasets.iteritems():
-            product_datasets = map(lambda x: os.path.join(product_id, x), product_items)
-            result.extend(product_datasets)
+        line_format = os.path.join
+
+    def iter_lines():
+        with storage_type.get_session() as storage:
+            separator = ''
+            for product_id, dataset_name in storage.iter_search_datasets( minD
+                                                                        , maxD
+                                                                        , extent
+                                                                        , products_filter
+                                                                        , patterns):
+                yield separator
+                yield line_format(product_id, dataset_name)
+                separator = '\n'
 
-    return '\n'.join(result)
+    r = Response()
+    r.content_type = 'text/plain'
+    r.vary = ('Accept-Encoding',)
+    content = iter_chunks(iter_lines())
+    if compress_search is True and 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', ''):
+        r.content_encoding = 'gzip'
+        content = iter_gzip(content)
+    r.app_iter = content
+    return r
 
 def find_nearest_dataset(environ, *args, **kwargs):
     """ """
@@ -294,43 +490,155 @@ def find_nearest_dataset(environ, *args, **kwargs):
 
     d = datetime.datetime.utcfromtimestamp(float(kwargs['date']))
 
-    with storage_type.get_session() as storage:
-        ts, before, after = storage.find_nearest( direction
-                                                , d
-                                                , extent
-                                                , products_filter
-                                                , patterns
-                                                , 300)
-
-    result = { 'nearestDataDate': ts
-             , 'before_delta': before
-             , 'after_delta': after
-    }
+    def compute():
+        with storage_type.get_session() as storage:
+            ts, before, after = storage.find_nearest( direction
+                                                    , d
+                                                    , extent
+                                                    , products_filter
+                                                    , patterns
+                                                    , 300)
+        return { 'nearestDataDate': ts
+               , 'before_delta': before
+               , 'after_delta': after
+        }
+
+    content = get_cached_json('nearest', kwargs, products_filter, compute)
+    return get_json_response(content, kwargs)
+
+def histogram(environ, *args, **kwargs):
+    """ """
+    required = [ 'productId', 'datasetId', 'x1', 'y1', 'x2', 'y2', 'zoomLevel']
+    missing = [x for x in required if x not in kwargs or 0 >= len(x)]
+    if 0 < len(missing):
+        msg = '{}  parameter(s) must be present in the request'
+        msg = msg.format(', '.join(missing))
+        return {'ok': False, 'details': msg}
+
+    samples = int(kwargs.get('samples', syntool_metadata.histogram.DEFAULT_SAMPLES))
+    if 0 >= samples or syntool_metadata.histogram.MAX_SAMPLES < samples:
+        msg = 'samples must be between 1 and {}'
+        msg = msg.format(syntool_metadata.histogram.MAX_SAMPLES)
+        return {'ok': False, 'details': msg}
+
+    dataset_id, dataset_type = kwargs['datasetId'].split('+', 1)
+    args = ( root_dir
+           , kwargs['productId']
+           , dataset_id
+           , dataset_type
+           , float(kwargs['x1'])
+           , float(kwargs['y1'])
+           , float(kwargs['x2'])
+           , float(kwargs['y2'])
+           , int(kwargs['zoomLevel'])
+           , samples)
+    if 'IMAGE' == dataset_type:
+        # The extent of the image is read from the database
+        with storage_type.get_session() as storage:
+            result = syntool_metadata.histogram.get(*args, db_storage=storage)
+    else:
+        result = syntool_metadata.histogram.get(*args)
 
     if 'callback' in kwargs:
       return '{}({})'.format(kwargs['callback'], json.dumps(result))
     else:
       return result
 
-def histogram(environ, *args, **kwargs):
-    """ """
-    required = [ 'productId', 'datasetId', 'x1', 'y1', 'x2', 'y2', 'zoomLevel']
+def batch_histogram(environ, *args, **kwargs):
+    """Sample several datasets along a polyline."""
+    required = [ 'datasets', 'polyline', 'zoomLevel']
+    missing = [x for x in required if x not in kwargs or 0 >= len(x)]
+    if 0 < len(missing):
+        msg = '{}  parameter(s) must be present in the request'
+        msg = msg.format(', '.join(missing))
+        return {'ok': False, 'details': msg}
+
+    # product_id+dataset_id+dataset_type, comma-separated
+    datasets = [x.split('+') for x in kwargs['datasets'].split(',')]
+    if syntool_metadata.histogram.MAX_BATCH_DATASETS < len(datasets):
+        msg = 'At most {} datasets can be sampled in a single request'
+        msg = msg.format(syntool_metadata.histogram.MAX_BATCH_DATASETS)
+        return {'ok': False, 'details': msg}
+    if any([3 != len(x) for x in datasets]):
+        msg = 'datasets must be formatted as productId+datasetId+type'
+        return {'ok': False, 'details': msg}
+
+    # x1,y1,x2,y2,...,xn,yn
+    coordinates = map(float, kwargs['polyline'].split(','))
+    if 4 > len(coordinates) or 0 != len(coordinates) % 2:
+        msg = 'polyline must contain the x,y coordinates of at least 2 points'
+        return {'ok': False, 'details': msg}
+    points = zip(coordinates[0::2], coordinates[1::2])
+
+    samples = int(kwargs.get('samples', syntool_metadata.histogram.DEFAULT_SAMPLES))
+    total_samples = samples * (len(points) - 1)
+    if 0 >= samples or syntool_metadata.histogram.MAX_SAMPLES < total_samples:
+        msg = 'samples per segment must be between 1 and {} in total'
+        msg = msg.format(syntool_metadata.histogram.MAX_SAMPLES)
+        return {'ok': False, 'details': msg}
+
+    args = ( root_dir
+           , datasets
+           , points
+           , int(kwargs['zoomLevel'])
+           , samples
+           , histogram_workers)
+    if any(['IMAGE' == x[2] for x in datasets]):
+        # The extent of the images is read from the database
+        with storage_type.get_session() as storage:
+            profiles = syntool_metadata.histogram.get_batch(*args, db_storage=storage)
+    else:
+        profiles = syntool_metadata.histogram.get_batch(*args)
+    result = {'profiles': profiles}
+
+    if 'callback' in kwargs:
+      return '{}({})'.format(kwargs['callback'], json.dumps(result))
+    else:
+      return result
+
+def area_statistics(environ, *args, **kwargs):
+    """Statistics of the values of a dataset inside an area."""
+    required = [ 'productId', 'datasetId', 'x1', 'y1', 'x2', 'y2', 'resolution']
     missing = [x for x in required if x not in kwargs or 0 >= len(x)]
     if 0 < len(missing):
         msg = '{}  parameter(s) must be present in the request'
         msg = msg.format(', '.join(missing))
         return {'ok': False, 'details': msg}
 
+    bins = int(kwargs.get('bins', syntool_metadata.statistics.DEFAULT_BINS))
+    if 0 >= bins or syntool_metadata.statistics.MAX_BINS < bins:
+        msg = 'bins must be between 1 and {}'
+        msg = msg.format(syntool_metadata.statistics.MAX_BINS)
+        return {'ok': False, 'details': msg}
+
+    percentiles = syntool_metadata.statistics.DEFAULT_PERCENTILES
+    if 'percentiles' in kwargs and 0 < len(kwargs['percentiles']):
+        percentiles = map(float, kwargs['percentiles'].split(','))
+        if any([0 > p or 100 < p for p in percentiles]):
+            msg = 'percentiles must be between 0 and 100'
+            return {'ok': False, 'details': msg}
+
     dataset_id, dataset_type = kwargs['datasetId'].split('+', 1)
-    result = syntool_metadata.histogram.get( root_dir
-					   , kwargs['productId']
-					   , dataset_id
-                                           , dataset_type
-					   , float(kwargs['x1'])
-                                           , float(kwargs['y1'])
-                                           , float(kwargs['x2'])
-                                           , float(kwargs['y2'])
-                                           , int(kwargs['zoomLevel']))
+    try:
+        result = syntool_metadata.statistics.get( root_dir
+                                                , kwargs['productId']
+                                                , dataset_id
+                                                , dataset_type
+                                                , float(kwargs['x1'])
+                                                , float(kwargs['y1'])
+                                                , float(kwargs['x2'])
+                                                , float(kwargs['y2'])
+                                                , float(kwargs['resolution'])
+                                                , bins
+                                                , percentiles)
+    except syntool_metadata.statistics.TooManyTilesException:
+        msg = 'Area too large for the requested resolution, please request ' \
+              'a coarser resolution'
+        return {'ok': False, 'details': msg}
+    except (syntool_metadata.statistics.DatasetTypeNotSupportedException,
+            syntool_metadata.statistics.DatasetNotAvailableException):
+        _, e, _ = sys.exc_info()
+        return {'ok': False, 'details': str(e)}
 
     if 'callback' in kwargs:
       return '{}({})'.format(kwargs['callback'], json.dumps(result))
@@ -346,29 +654,44 @@ def download_png(environ, *args, **kwargs):
         msg = msg.format(', '.join(missing))
         return {'ok': False, 'details': msg}
 
-    if 'SERVER_HOST' not in environ:
-        msg = 'Webserver misconfigured: missing SERVER_HOST environment variable'
-        return { 'ok': False, 'details': msg}
+    output_format = kwargs.get('format', archive_format)
+    if output_format not in syntool_metadata.extract.ARCHIVE_FORMATS:
+        msg = 'format must be one of {}'
+        msg = msg.format(', '.join(sorted(syntool_metadata.extract.ARCHIVE_FORMATS)))
+        return {'ok': False, 'details': msg}
 
-    with storage_type.get_session() as storage:
-        results = syntool_metadata.extract.get( root_dir
-                                              , kwargs['datasets'].split(',')
-					      , float(kwargs['x1'])
-                                              , float(kwargs['y1'])
-                                              , float(kwargs['x2'])
-                                              , float(kwargs['y2'])
-                                              , float(kwargs['resolution'])
-                                              , 'PNG'
-                                              , environ['SERVER_HOST']
-                                              , download_dir
-                                              , storage)
-    with open(results, 'r') as f:
-        content = f.read()
+    # Fast preview: allow reading a slightly coarser zoom level
+    tolerance = 1.0
+    if parse_bool(kwargs.get('preview', False)):
+        tolerance = preview_tolerance
+
+    try:
+        with storage_type.get_session() as storage:
+            # Datasets are resolved here, the archive is generated while the
+            # response is sent
+            content = syntool_metadata.extract.stream( root_dir
+                                                     , kwargs['datasets'].split(',')
+                                                     , float(kwargs['x1'])
+                                                     , float(kwargs['y1'])
+                                                     , float(kwargs['x2'])
+                                                     , float(kwargs['y2'])
+                                                     , float(kwargs['resolution'])
+                                                     , storage
+                                                     , output_format
+                                                     , extract_workers
+                                                     , decode_threads
+                                                     , extract_max_memory
+                                                     , tolerance)
+    except syntool_metadata.extract.ExtractionTooLargeException:
+        msg = 'Extraction too large, please select a smaller area, a ' \
+              'coarser resolution or fewer datasets'
+        return {'ok': False, 'details': msg}
 
     n = datetime.datetime.now()
-    default_filename = 'syntool-archive-{}.tgz'.format(n.strftime('%Y%m%d_%H%M%S'))
+    default_filename = 'syntool-archive-{}.{}'.format(n.strftime('%Y%m%d_%H%M%S'),
+                                                      output_format)
     r = Response()
-    r.body = content
+    r.app_iter = content
     r.content_type = 'application/octet-stream'
     r.content_disposition = 'attachement; filename={}'.format(default_filename)
     r.content_description = 'File transfer'
@@ -387,18 +710,32 @@ def download_numpy(environ, *args, **kwargs):
         msg = 'Webserver misconfigured: missing SERVER_HOST environment variable'
         return { 'ok': False, 'details': msg}
 
-    with storage_type.get_session() as storage:
-        results = syntool_metadata.extract.get( root_dir
-                                              , kwargs['datasets'].split(',')
-					      , float(kwargs['x1'])
-                                              , float(kwargs['y1'])
-                                              , float(kwargs['x2'])
-                                              , float(kwargs['y2'])
-                                              , float(kwargs['resolution'])
-                                              , 'NUMPY'
-                                              , environ['SERVER_HOST']
-                                              , download_dir
-                                              , storage)
+    # Fast preview: allow reading a slightly coarser zoom level
+    tolerance = 1.0
+    if parse_bool(kwargs.get('preview', False)):
+        tolerance = preview_tolerance
+
+    try:
+        with storage_type.get_session() as storage:
+            results = syntool_metadata.extract.get( root_dir
+                                                  , kwargs['datasets'].split(',')
+                                                  , float(kwargs['x1'])
+                                                  , float(kwargs['y1'])
+                                                  , float(kwargs['x2'])
+                                                  , float(kwargs['y2'])
+                                                  , float(kwargs['resolution'])
+                                                  , 'NUMPY'
+                                                  , environ['SERVER_HOST']
+                                                  , download_dir
+                                                  , storage
+                                                  , extract_workers
+                                                  , decode_threads
+                                                  , extract_max_memory
+                                                  , tolerance)
+    except syntool_metadata.extract.ExtractionTooLargeException:
+        msg = 'Extraction too large, please select a smaller area, a ' \
+              'coarser resolution or fewer datasets'
+        return {'ok': False, 'details': msg}
 
     if 'callback' in kwargs:
       return '{}({})'.format(kwargs['callback'], json.dumps(results))
@@ -429,6 +766,15 @@ routes = route(
     route( GET
          , '{}histogram.service.php'.format(url_prefix)
          , histogram),
+    route( GET
+         , '{}histograms.service.php'.format(url_prefix)
+         , batch_histogram),
+    route( POST
+         , '{}histograms.service.php'.format(url_prefix)
+         , batch_histogram),
+    route( GET
+         , '{}statistics.service.php'.format(url_prefix)
+         , area_statistics),
     route( GET
          , '{}downloadRaster.service.php'.format(url_prefix)
          , download_png),
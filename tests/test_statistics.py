@@ -0,0 +1,53 @@
+# -*- encoding: utf-8 -*-
+
+"""
+Copyright (C) 2014-2018 OceanDataLab
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import shutil
+import tempfile
+import unittest
+import syntool_metadata.statistics
+
+
+class GetTestCase(unittest.TestCase):
+    """ """
+
+    def setUp(self):
+        """ """
+        self.root_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """ """
+        shutil.rmtree(self.root_dir)
+
+    def test_unsupported_type(self):
+        """IMAGE datasets are rejected with a dedicated exception."""
+        with self.assertRaises(syntool_metadata.statistics.DatasetTypeNotSupportedException):
+            syntool_metadata.statistics.get( self.root_dir, '3857_product'
+                                           , 'dataset', 'IMAGE'
+                                           , 0.0, 0.0, 1000.0, 1000.0, 10.0)
+
+    def test_missing_tilemap(self):
+        """ZXY datasets without a tilemap are reported as not available."""
+        with self.assertRaises(syntool_metadata.statistics.DatasetNotAvailableException):
+            syntool_metadata.statistics.get( self.root_dir, '3857_product'
+                                           , 'dataset', 'ZXY'
+                                           , 0.0, 0.0, 1000.0, 1000.0, 10.0)
+
+
+if __name__ == '__main__':
+    unittest.main()